@@ -0,0 +1,226 @@
+'''
+An in-process HTTP load generator for the API.
+
+Each worker thread has its own Flask test client and random number generator
+and repeatedly picks a scenario from a weighted traffic mix. Only the time
+spent handling requests is measured: test data such as upload bodies is
+prepared before the timer starts.
+
+To benchmark without a MySQL server, set `driver = sqlite` in the [database]
+section of conf/local.ini before building the sample database (see run.py).
+'''
+
+from collections import defaultdict
+import random
+import threading
+import time
+
+from itsdangerous import Signer
+
+import model.sample
+
+# Scenario name: relative weight. Roughly what a page view of the site does.
+TRAFFIC_MIX = {
+    'index': 5,
+    'letter': 10,
+    'detail': 25,
+    'search': 10,
+    'suggest': 10,
+    'votes': 10,
+    'vote': 3,
+    'image': 7,
+    'thumbnail': 17,
+    'upload': 1,
+}
+
+
+class LoadTest:
+    ''' Drive a Flask app with a weighted mix of API requests. '''
+
+    def __init__(self, flask_app, session, user, seed=0):
+        ''' Constructor. '''
+
+        from model import Codename, Image
+
+        self._flask_app = flask_app
+        self._seed = seed
+
+        signer = Signer(flask_app.config['SECRET_KEY'])
+        token = signer.sign(str(user.id).encode('utf8')).decode('utf8')
+        self._auth = {'auth': token}
+
+        slugs = session.query(Codename.slug).order_by(Codename.id).all()
+        self._slugs = [slug for slug, in slugs]
+
+        images = session.query(Image.id, Codename.slug) \
+                        .join(Image.codename) \
+                        .filter(Image.approved == True, Image.ready == True) \
+                        .order_by(Image.id) \
+                        .all()
+
+        self._images = [(image_id, slug) for image_id, slug in images]
+
+        if len(self._slugs) == 0 or len(self._images) == 0:
+            raise ValueError('The database has no codenames or images. Run'
+                             ' `bin/database.py build --sample-data N`'
+                             ' first.')
+
+    def run(self, concurrency, duration, warmup=0):
+        '''
+        Run `concurrency` workers for `warmup` seconds without measuring and
+        then for `duration` seconds, and return a dict of results.
+        '''
+
+        samples = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+
+        if warmup > 0:
+            self._run_workers(concurrency, warmup, None, None, None)
+
+        start = time.monotonic()
+        self._run_workers(concurrency, duration, samples, errors, lock)
+        elapsed = time.monotonic() - start
+
+        return _summarize(samples, errors, elapsed)
+
+    def _request(self, client, rng, scenario):
+        '''
+        Prepare and send a request for `scenario`. Returns the time spent
+        handling it and whether it succeeded.
+        '''
+
+        slug = rng.choice(self._slugs)
+        image_id, image_slug = rng.choice(self._images)
+        base = '/api/codename/'
+        headers = {'accept': 'application/json'}
+        method = 'get'
+        data = None
+
+        if scenario == 'index':
+            url = base
+        elif scenario == 'letter':
+            url = base + '?page=' + rng.choice('ABCDEFGHIJKLMNOPRSTUVWYZ')
+        elif scenario == 'detail':
+            url = base + slug
+        elif scenario == 'search':
+            url = base + 'search?q=' + rng.choice(model.sample.WORDS)
+        elif scenario == 'suggest':
+            prefix = rng.choice(model.sample.SYLLABLES)
+            url = base + 'suggest?q=' + prefix
+        elif scenario == 'votes':
+            sample = rng.sample(self._images, min(10, len(self._images)))
+            ids = ','.join(str(id_) for id_, _ in sample)
+            url = base + 'votes?ids=' + ids
+            headers.update(self._auth)
+        elif scenario == 'vote':
+            url = '%s%s/images/%d/vote' % (base, image_slug, image_id)
+            method = rng.choice(('post', 'delete'))
+            headers.update(self._auth)
+        elif scenario == 'image':
+            url = '%s%s/images/%d' % (base, image_slug, image_id)
+        elif scenario == 'thumbnail':
+            url = '%s%s/images/%d/thumbnail' % (base, image_slug, image_id)
+        elif scenario == 'upload':
+            url = '%s%s/images' % (base, slug)
+            method = 'post'
+            data = model.sample.make_image(rng.getrandbits(64))
+            headers.update(self._auth)
+            headers['content-type'] = 'image/jpeg'
+        else:
+            raise ValueError('Unknown scenario: %s' % scenario)
+
+        start = time.perf_counter()
+        response = getattr(client, method)(url, headers=headers, data=data)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        response.close()
+
+        ok = response.status_code < 400
+
+        return elapsed, ok
+
+    def _run_workers(self, concurrency, duration, samples, errors, lock):
+        ''' Run workers until `duration` seconds have passed. '''
+
+        deadline = time.monotonic() + duration
+        scenarios = sorted(TRAFFIC_MIX)
+        weights = [TRAFFIC_MIX[scenario] for scenario in scenarios]
+
+        def worker(index):
+            rng = random.Random('%s-%d' % (self._seed, index))
+            client = self._flask_app.test_client()
+            local_samples = defaultdict(list)
+            local_errors = defaultdict(int)
+
+            while time.monotonic() < deadline:
+                scenario = rng.choices(scenarios, weights)[0]
+                elapsed, ok = self._request(client, rng, scenario)
+                local_samples[scenario].append(elapsed)
+
+                if not ok:
+                    local_errors[scenario] += 1
+
+            if samples is not None:
+                with lock:
+                    for scenario, times in local_samples.items():
+                        samples[scenario].extend(times)
+
+                    for scenario, count in local_errors.items():
+                        errors[scenario] += count
+
+        threads = [
+            threading.Thread(target=worker, args=(index,))
+            for index in range(concurrency)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+
+def _percentile(sorted_times, percent):
+    ''' Return a percentile (nearest rank) of a sorted list, in ms. '''
+
+    rank = max(int(round(percent / 100 * len(sorted_times))) - 1, 0)
+
+    return round(sorted_times[rank] * 1000, 3)
+
+
+def _summarize(samples, errors, elapsed):
+    ''' Compute throughput and latency percentiles. '''
+
+    endpoints = dict()
+    all_times = list()
+
+    for scenario, times in sorted(samples.items()):
+        times.sort()
+        all_times.extend(times)
+        endpoints[scenario] = _stats(times, errors[scenario], elapsed)
+
+    all_times.sort()
+
+    return {
+        'seconds': round(elapsed, 3),
+        'total': _stats(all_times, sum(errors.values()), elapsed),
+        'endpoints': endpoints,
+    }
+
+
+def _stats(sorted_times, errors, elapsed):
+    ''' Compute statistics for one list of request times. '''
+
+    if len(sorted_times) == 0:
+        return {'requests': 0, 'errors': errors}
+
+    return {
+        'requests': len(sorted_times),
+        'errors': errors,
+        'requestsPerSecond': round(len(sorted_times) / elapsed, 2),
+        'meanMs': round(sum(sorted_times) / len(sorted_times) * 1000, 3),
+        'p50Ms': _percentile(sorted_times, 50),
+        'p95Ms': _percentile(sorted_times, 95),
+        'p99Ms': _percentile(sorted_times, 99),
+    }
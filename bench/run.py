@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+Benchmark the API in-process against a seeded local database.
+
+    bin/database.py build --sample-data 2000
+    bench/run.py --concurrency 8 --duration 30 --output before.json
+
+Results are JSON: requests per second and p50/p95/p99 latency for each
+scenario in the traffic mix (see load.py), plus the commit that was tested.
+Sample data is deterministic. Uploads and votes modify the database, so
+rebuild it before each run that will be compared with another.
+'''
+
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import app
+import app.config
+import app.database
+import cli
+from model import User
+
+import load
+
+
+class BenchCli(cli.BaseCli):
+    ''' A tool for benchmarking the API. '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for the traffic mix. (Default: 0)'
+        )
+
+        arg_parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=8,
+            help='Number of concurrent clients. (Default: 8)'
+        )
+
+        arg_parser.add_argument(
+            '--duration',
+            type=float,
+            default=30,
+            help='Seconds to measure for. (Default: 30)'
+        )
+
+        arg_parser.add_argument(
+            '--warmup',
+            type=float,
+            default=5,
+            help='Seconds to run before measuring. (Default: 5)'
+        )
+
+        arg_parser.add_argument(
+            '--output',
+            help='Write results to this file instead of stdout.'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        database_config = dict(config.items('database'))
+        engine = app.database.get_engine(database_config)
+        session = app.database.get_session(engine)
+
+        try:
+            user = session.query(User).order_by(User.id).first()
+
+            if user is None:
+                message = 'Run `bin/database.py build --sample-data N` first.'
+                raise cli.CliError(message)
+
+            flask_app = app.bootstrap(record_metrics=False)
+
+            try:
+                test = load.LoadTest(flask_app, session, user, args.seed)
+            except ValueError as e:
+                raise cli.CliError(str(e))
+        finally:
+            session.close()
+
+        self._logger.info(
+            'Running %d clients for %.0f seconds (after %.0f seconds of'
+            ' warmup).', args.concurrency, args.duration, args.warmup
+        )
+
+        results = test.run(args.concurrency, args.duration, args.warmup)
+        results['run'] = {
+            'commit': self._get_commit(),
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'seed': args.seed,
+        }
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+
+        if args.output is None:
+            print(output)
+        else:
+            with open(args.output, 'w') as output_file:
+                output_file.write(output + '\n')
+
+    def _get_commit(self):
+        ''' Return the current git commit, or None. '''
+
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=app.config.get_path(),
+                stderr=subprocess.DEVNULL
+            ).decode('ascii').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+if __name__ == '__main__':
+    BenchCli().run()
@@ -70,7 +70,7 @@ python3 $ROOT_PATH/bin/database.py build
 make-ssl-cert /usr/share/ssl-cert/ssleay.cnf /etc/apache2/server.crt
 
 # Apache setup.
-a2enmod headers rewrite ssl wsgi
+a2enmod headers rewrite ssl wsgi xsendfile
 ln -s $ROOT_PATH/install/apache.conf \
     /etc/apache2/sites-available/nsa-codenames.conf
 a2ensite nsa-codenames
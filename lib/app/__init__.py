@@ -1,14 +1,83 @@
-from flask import Flask, g, jsonify, make_response, request
+import threading
+import time
+
+from flask import Flask, g, has_request_context, jsonify, make_response, \
+                  request
+from flask.ctx import _AppCtxGlobals
 from flask.ext.assets import Environment, Bundle
 from flask_failsafe import failsafe
 from itsdangerous import Signer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
+import app.cache
 import app.config
 import app.database
+import app.metrics
+import app.profiler
+import app.typeahead
 
 
 flask_app = None
 
+# After a client's write, its reads go to the primary database until the time
+# in this cookie, so that it sees its own writes despite replication lag.
+PRIMARY_COOKIE = 'read_primary_until'
+
+
+class MyGlobals(_AppCtxGlobals):
+    """
+    Customized request globals (`g`).
+
+    Features:
+     * `g.db` is a database session that is created the first time it is
+       used, so requests that don't use the database never touch the pool.
+     * GET requests are routed to a read replica, if any are configured,
+       unless the client wrote recently (see PRIMARY_COOKIE).
+    """
+
+    @property
+    def db(self):
+        """ Return this request's database session, creating it if needed. """
+
+        if '_db' not in self.__dict__:
+            database_config = dict(self.config.items('database'))
+            engine = None
+
+            if self._is_replica_safe():
+                engine = app.database.get_replica_engine(database_config)
+
+            if engine is None:
+                engine = app.database.get_engine(database_config)
+
+            self._db = app.database.get_session(engine)
+
+        return self._db
+
+    def close_db(self):
+        """ Close the database session, if one was created. """
+
+        session = self.__dict__.pop('_db', None)
+
+        if session is not None:
+            session.close()
+
+    def _is_replica_safe(self):
+        """
+        Return True if this request may read from a replica: it is read-only
+        and the client has not written anything recently.
+        """
+
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+
+        try:
+            primary_until = float(request.cookies[PRIMARY_COOKIE])
+        except (KeyError, ValueError):
+            return True
+
+        return time.time() >= primary_until
+
 
 class MyFlask(Flask):
     """
@@ -16,8 +85,11 @@ class MyFlask(Flask):
 
     Features:
      * Changes jinja2 delimiters from {{foo}} to [[foo]].
+     * Uses MyGlobals for `g`.
     """
 
+    app_ctx_globals_class = MyGlobals
+
     jinja_options = Flask.jinja_options.copy()
     jinja_options.update({
         "block_start_string": "[%",
@@ -30,8 +102,13 @@ class MyFlask(Flask):
 
 
 @failsafe
-def bootstrap(debug=False, debug_db=False):
-    """ Bootstrap the Flask application and return a reference to it. """
+def bootstrap(debug=False, debug_db=False, record_metrics=True):
+    """
+    Bootstrap the Flask application and return a reference to it.
+
+    Command line tools that make requests with a test client should pass
+    `record_metrics=False` (see app.metrics).
+    """
 
     global flask_app
 
@@ -46,18 +123,29 @@ def bootstrap(debug=False, debug_db=False):
     )
     flask_app.debug = debug
     flask_app.debug_db = debug_db
+    flask_app.record_metrics = record_metrics
 
     config = app.config.get_config()
 
     # Run the bootstrap.
     init_flask(flask_app, config)
+    init_metrics(flask_app, config)
+    init_profiler(flask_app, config)
+    init_cache(flask_app, config)
     init_errors(flask_app, config)
     init_webassets(flask_app, config)
+    init_typeahead(flask_app, config)
     init_views(flask_app, config)
 
     return flask_app
 
 
+def init_cache(flask_app, config):
+    ''' Initialize the response cache. '''
+
+    app.cache.init(config)
+
+
 def init_errors(flask_app, config):
     ''' Initialize error handlers. '''
 
@@ -106,24 +194,61 @@ def init_flask(flask_app, config):
     if flask_app.debug:
         flask_app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
 
-    @flask_app.after_request
-    def after_request(response):
-        ''' Clean up request context. '''
+    signer = Signer(config.get('flask', 'SECRET_KEY'))
+    sign = lambda s: signer.sign(str(s).encode('utf8')).decode('utf-8')
 
-        g.db.close()
+    database_config = dict(config.items('database'))
+    sticky_seconds = config.getint('database', 'replica_sticky_seconds')
+    replicas = app.database.get_replica_engines(database_config)
 
-        return response
+    if config.getboolean('database', 'detect_leaks'):
+        primary = app.database.get_engine(database_config)
+
+        for engine in [primary] + replicas:
+            app.database.enable_leak_detection(engine)
+
+    if replicas:
+        @flask_app.after_request
+        def stick_to_primary(response):
+            ''' Send a client's reads to the primary after it writes. '''
+
+            if request.method not in ('GET', 'HEAD', 'OPTIONS') and \
+               response.status_code < 400:
+                primary_until = time.time() + sticky_seconds
+                response.set_cookie(
+                    PRIMARY_COOKIE,
+                    '%.3f' % primary_until,
+                    max_age=sticky_seconds,
+                    httponly=True
+                )
+
+            return response
+
+    @flask_app.teardown_request
+    def teardown_request(exception):
+        '''
+        Clean up request context. Unlike an after_request hook, this also runs
+        when the view raises an exception.
+        '''
+
+        g.close_db()
+
+        thread_id = threading.get_ident()
+
+        for age, stack in app.database.get_checkouts(thread_id):
+            flask_app.logger.warning(
+                'Database connection still checked out at the end of request'
+                ' "%s" (%.1f seconds after checkout). It was checked out'
+                ' at:\n%s', request.path, age, stack
+            )
 
     @flask_app.before_request
     def before_request():
         ''' Initialize request context. '''
 
-        engine = app.database.get_engine(dict(config.items('database')))
-        g.db = app.database.get_session(engine)
         g.config = config
 
-        signer = Signer(config.get('flask', 'SECRET_KEY'))
-        g.sign = lambda s: signer.sign(str(s).encode('utf8')).decode('utf-8')
+        g.sign = sign
         g.unsign = signer.unsign
 
         g.debug = flask_app.debug
@@ -174,6 +299,220 @@ def init_logging(flask_app, config):
         db_logger.addHandler(db_log_handler)
 
 
+def init_metrics(flask_app, config):
+    '''
+    Initialize the metrics registry (see app.metrics) and record metrics for
+    each request.
+    '''
+
+    if flask_app.record_metrics:
+        metrics_dir = app.config.get_path(config.get('metrics', 'dir'))
+    else:
+        metrics_dir = None
+
+    metrics = app.metrics.Registry(metrics_dir)
+    flask_app.metrics = metrics
+
+    requests_total = metrics.counter(
+        'nsa_http_requests_total',
+        'HTTP requests by endpoint, method, and status.'
+    )
+    request_seconds = metrics.histogram(
+        'nsa_http_request_duration_seconds',
+        'Time spent handling HTTP requests.'
+    )
+    response_bytes = metrics.histogram(
+        'nsa_http_response_size_bytes',
+        'Size of HTTP response bodies.',
+        app.metrics.SIZE_BUCKETS
+    )
+    sql_statements = metrics.histogram(
+        'nsa_sql_statements_per_request',
+        'SQL statements executed per HTTP request.',
+        app.metrics.COUNT_BUCKETS
+    )
+    sql_seconds = metrics.histogram(
+        'nsa_sql_duration_seconds_per_request',
+        'Time spent executing SQL statements per HTTP request.'
+    )
+    metrics.histogram(
+        'nsa_upload_processing_seconds',
+        'Time from submitting an uploaded image for processing until it is'
+        ' ready, including time waiting for a worker.'
+    )
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(time.monotonic())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.monotonic() - conn.info['query_start'].pop()
+
+        if has_request_context() and hasattr(g, 'sql_statements'):
+            g.sql_statements += 1
+            g.sql_seconds += elapsed
+
+    @flask_app.before_request
+    def start_request_metrics():
+        g.request_start = time.monotonic()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    @flask_app.after_request
+    def record_request_metrics(response):
+        if response.is_streamed:
+            # The body is produced after this hook, so the request is
+            # recorded in teardown, which runs when the stream ends.
+            g.response_status = response.status_code
+            g.response_size = 0
+            response.response = _count_bytes(
+                g._get_current_object(),
+                response.response
+            )
+        else:
+            size = response.calculate_content_length()
+            _record_request(response.status_code, size)
+
+        return response
+
+    @flask_app.teardown_request
+    def record_remaining_request_metrics(exception):
+        # after_request hooks do not run for unhandled exceptions.
+        if not hasattr(g, 'request_start'):
+            return
+
+        if isinstance(exception, Exception):
+            _record_request(500, None)
+        else:
+            status = getattr(g, 'response_status', 500)
+            _record_request(status, getattr(g, 'response_size', None))
+
+    def _count_bytes(globals_, chunks):
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    globals_.response_size += len(chunk.encode('utf8'))
+                else:
+                    globals_.response_size += len(chunk)
+
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def _record_request(status, size):
+        endpoint = request.endpoint or 'none'
+        elapsed = time.monotonic() - g.request_start
+
+        # Make sure the request is not recorded again in teardown.
+        del g.request_start
+
+        requests_total.inc(
+            endpoint=endpoint,
+            method=request.method,
+            status=str(status)
+        )
+        request_seconds.observe(elapsed, endpoint=endpoint)
+        sql_statements.observe(g.sql_statements, endpoint=endpoint)
+        sql_seconds.observe(g.sql_seconds, endpoint=endpoint)
+
+        if size is not None:
+            response_bytes.observe(size, endpoint=endpoint)
+
+
+def init_profiler(flask_app, config):
+    '''
+    If enabled, profile the SQL statements of each request (see app.profiler).
+
+    The statement count and time are returned in `X-Query-Count` and
+    `Server-Timing` headers, and a warning is logged when one request runs the
+    same statement shape more than `repeat_threshold` times. For streamed
+    responses, the headers cover the statements run before the body started
+    (see app.rest.stream_json) and the warning covers the whole request.
+    '''
+
+    if not config.getboolean('profiler', 'enabled'):
+        return
+
+    threshold = config.getint('profiler', 'repeat_threshold')
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('profile_start', []).append(time.monotonic())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.monotonic() - conn.info['profile_start'].pop()
+
+        if has_request_context() and hasattr(g, 'profile'):
+            g.profile.add(statement, elapsed)
+
+    @flask_app.before_request
+    def start_profile():
+        g.profile = app.profiler.RequestProfile()
+        g.profile_start = time.monotonic()
+
+    @flask_app.after_request
+    def finish_profile(response):
+        profile = g.profile
+        total_ms = (time.monotonic() - g.profile_start) * 1000
+        db_ms = profile.seconds * 1000
+
+        response.headers['X-Query-Count'] = str(profile.count)
+        response.headers.add(
+            'Server-Timing',
+            'db;dur=%.1f;desc="%d queries", total;dur=%.1f'
+            % (db_ms, profile.count, total_ms)
+        )
+
+        if response.is_streamed:
+            # Statements may still run while the body is streamed, so check
+            # for repeats in teardown, which runs when the stream ends.
+            g.profile_streamed = True
+        else:
+            _log_repeated(profile)
+
+        return response
+
+    @flask_app.teardown_request
+    def finish_streamed_profile(exception):
+        if getattr(g, 'profile_streamed', False):
+            _log_repeated(g.profile)
+
+    def _log_repeated(profile):
+        for shape, count, seconds in profile.get_repeated(threshold):
+            flask_app.logger.warning(
+                'Possible N+1 query in %s %s (endpoint %s): statement ran %d'
+                ' times (%.1f ms): %s', request.method, request.path,
+                request.endpoint, count, seconds * 1000, shape
+            )
+
+
+def init_typeahead(flask_app, config):
+    ''' Build the in-memory index used for codename suggestions. '''
+
+    from model import Codename
+
+    engine = app.database.get_engine(dict(config.items('database')))
+
+    def load():
+        session = app.database.get_session(engine)
+
+        try:
+            return session.query(Codename.name, Codename.slug).all()
+        finally:
+            session.close()
+
+    version = app.cache.get_versions('codename-names')
+    flask_app.typeahead = app.typeahead.PrefixIndex(load)
+    flask_app.typeahead.rebuild(load(), version)
+
+
 def init_views(flask_app, config):
     """ Initialize views. """
 
@@ -189,9 +528,14 @@ def init_views(flask_app, config):
     from app.views.content import ContentView
     ContentView.register(flask_app, route_base='/api/content')
 
+    from app.views.stats import StatsView
+    StatsView.register(flask_app, route_base='/api/stats')
+
     from app.views.user import UserView
     UserView.register(flask_app, route_base='/api/user')
 
+    import app.views.metrics
+
     # Make sure to import the Angular view last so that it will match
     # all remaining routes.
     import app.views.angular
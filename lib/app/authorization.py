@@ -1,15 +1,33 @@
+from collections import namedtuple, OrderedDict
 from functools import wraps
+import threading
+import time
 
 from flask import g, request
 from werkzeug.exceptions import BadRequest, Forbidden, Unauthorized
 
+import app.cache
 from model import User
 
+# The fields of a user that are needed to authorize a request. Views that need
+# anything else (or need to modify the user) should load the User row.
+AuthenticatedUser = namedtuple(
+    'AuthenticatedUser',
+    ['id', 'username', 'image_url', 'is_admin']
+)
+
+# The maximum number of users to cache in each process.
+USER_CACHE_SIZE = 10000
+
+_users = OrderedDict()
+_users_lock = threading.Lock()
+
 def login_optional(original_function):
     '''
     A decorator that checks if a user is logged in.
 
-    If the user is logged in, then the user object will be attached to 'g'.
+    If the user is logged in, then an AuthenticatedUser will be attached to
+    'g'.
     If the user is not logged in, then g.user will be None.
     '''
 
@@ -26,7 +44,7 @@ def login_required(original_function):
 
     A user is logged in if the user has a valid auth header that
     refers to a valid user object. If the user is logged in, then
-    the user object will be attached to 'g'.
+    an AuthenticatedUser will be attached to 'g'.
     '''
 
     @wraps(original_function)
@@ -40,7 +58,7 @@ def admin_required(original_function):
     '''
     A decorator that requires a logged in user to be an admin.
 
-    If the user is an admin, then the user object will be attached
+    If the user is an admin, then an AuthenticatedUser will be attached
     to 'g'.
     '''
 
@@ -57,6 +75,56 @@ def admin_required(original_function):
 
     return wrapper
 
+def invalidate_user(user_id):
+    '''
+    Discard the cached copy of a user after it is modified.
+
+    This takes effect immediately in this process and on the next request in
+    any other process (including web workers, when called from a CLI).
+    '''
+
+    with _users_lock:
+        _users.pop(user_id, None)
+
+    app.cache.invalidate('user:%d' % user_id)
+
+def _get_user(user_id):
+    '''
+    Load an AuthenticatedUser, from the cache if possible.
+
+    Cached users expire after `[cache] user_ttl` seconds, or as soon as
+    `invalidate_user()` is called in any process.
+    '''
+
+    version = app.cache.get_versions('user:%d' % user_id)
+    now = time.monotonic()
+
+    with _users_lock:
+        entry = _users.get(user_id)
+
+        if entry is not None:
+            expires, entry_version, user = entry
+
+            if expires > now and entry_version == version:
+                _users.move_to_end(user_id)
+                return user
+
+    row = g.db.query(User.id, User.username, User.image_url, User.is_admin) \
+              .filter(User.id==user_id) \
+              .one()
+
+    user = AuthenticatedUser(*row)
+    expires = now + g.config.getint('cache', 'user_ttl')
+
+    with _users_lock:
+        _users[user_id] = (expires, version, user)
+        _users.move_to_end(user_id)
+
+        while len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+
+    return user
+
 def _get_user_from_auth_header(required=True):
     '''
     Try to read an auth token and load a corresponding user.
@@ -67,9 +135,7 @@ def _get_user_from_auth_header(required=True):
 
     try:
         user_id = int(g.unsign(request.headers['auth']))
-        user = g.db.query(User) \
-                   .filter(User.id==user_id) \
-                   .one()
+        user = _get_user(user_id)
     except:
         if required:
             raise Unauthorized("Invalid auth token.")
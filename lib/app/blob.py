@@ -0,0 +1,72 @@
+''' Serve content-addressed files from the data directory. '''
+
+import os
+
+from flask import current_app, g, request, send_file
+from werkzeug.exceptions import NotFound
+
+import app.config
+
+CACHE_MAX_AGE = 31536000
+CACHE_CONTROL = 'public, max-age=%d, immutable' % CACHE_MAX_AGE
+
+
+def send_blob(rel_path, mimetype):
+    '''
+    Send a file from the data directory.
+
+    Files in the data directory are named after the SHA-1 hash of their
+    contents, so the path itself is a strong validator: it is used as the ETag
+    and the response may be cached forever. A request whose If-None-Match
+    header already names the file is answered with 304 without touching the
+    file system. Range requests are supported.
+
+    The `delivery` option in the `[images]` config section selects how the
+    file body is sent: "python" streams it from this process, while
+    "x-sendfile" and "x-accel-redirect" return an empty response with a header
+    that tells the front end web server to send the file itself.
+    '''
+
+    etag = rel_path.replace(os.sep, '')
+    delivery = g.config.get('images', 'delivery')
+    size = None
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    elif delivery == 'x-sendfile':
+        path = os.path.join(app.config.get_path('data'), rel_path)
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Sendfile'] = path
+    elif delivery == 'x-accel-redirect':
+        prefix = g.config.get('images', 'accel_prefix').rstrip('/')
+        location = '/'.join([prefix] + rel_path.split(os.sep))
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = location
+    else:
+        path = os.path.join(app.config.get_path('data'), rel_path)
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise NotFound('The requested file does not exist.')
+
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            add_etags=False,
+            cache_timeout=CACHE_MAX_AGE
+        )
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+
+    if size is not None:
+        # This must follow set_etag(): If-Range and If-None-Match are checked
+        # against the response's ETag.
+        response.make_conditional(
+            request,
+            accept_ranges=True,
+            complete_length=size
+        )
+
+    return response
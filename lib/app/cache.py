@@ -0,0 +1,199 @@
+'''
+A cache for the responses of read-only API endpoints.
+
+Responses are cached under a key made from the endpoint, its arguments, the
+request's auth class (anonymous or authenticated), and the current version of
+each entity that the response depends on. Write views call `invalidate()` to
+bump those versions, so affected entries are never served again and are
+eventually evicted. Entries and versions are stored in a pluggable backend
+(see app.cache_backends), which shares versions between processes so that
+invalidations reach every worker.
+
+Entities are strings such as "codenames" (any list of codenames), "codename:x"
+(the codename with slug "x"), "content:x", or "users". The version of
+"codename-names" also tells each process when its typeahead index is stale.
+'''
+
+from functools import wraps
+import os
+import threading
+
+from flask import current_app, request
+
+import app.config
+from app.cache_backends import MemcachedBackend, MemoryBackend, \
+                               SharedMemoryBackend
+
+# Streamed responses are cached only if they are at most this size (bytes),
+# so that streaming a large response still uses little memory.
+MAX_STREAMED_BYTES = 1048576
+
+_backend = None
+_replica_lag = 0
+
+
+def cached(*entities, per_user=False):
+    '''
+    A decorator that caches a view's successful responses.
+
+    `entities` are format strings that are filled in with the view's keyword
+    arguments, e.g. "codename:{slug}". If `per_user` is True, then the response
+    contains data specific to the logged in user, so only anonymous requests
+    are cached.
+
+    This should be the outermost decorator so that cache hits skip
+    authentication entirely.
+    '''
+
+    def decorator(original_function):
+        @wraps(original_function)
+        def wrapper(*args, **kwargs):
+            authenticated = 'auth' in request.headers
+
+            if _backend is None or (per_user and authenticated):
+                return original_function(*args, **kwargs)
+
+            names = [entity.format(**kwargs) for entity in entities]
+
+            key = repr((
+                request.endpoint,
+                request.host_url,
+                sorted(kwargs.items()),
+                sorted(request.args.items(multi=True)),
+                'authenticated' if authenticated else 'anonymous',
+                _backend.get_versions(names),
+            ))
+
+            entry = _backend.get(key)
+
+            if entry is not None:
+                content_type, body = entry.split(b'\n', 1)
+                headers = [('Content-Type', content_type.decode('latin1'))]
+                return current_app.response_class(body, 200, headers)
+
+            response = current_app.make_response(
+                original_function(*args, **kwargs)
+            )
+
+            if response.status_code == 200:
+                content_type = response.headers['Content-Type']
+                header = content_type.encode('latin1') + b'\n'
+
+                if response.is_streamed:
+                    response.response = _cache_stream(
+                        key, header, response.response
+                    )
+                else:
+                    _backend.set(key, header + response.get_data())
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def get_stats():
+    ''' Return cache statistics for this process. '''
+
+    return _backend.stats() if _backend is not None else None
+
+
+def get_versions(*entities):
+    ''' Return a tuple of the current versions of `entities`. '''
+
+    return _backend.get_versions(entities)
+
+
+def init(config):
+    ''' Configure the cache backend from the `[cache]` config section. '''
+
+    global _backend, _replica_lag
+
+    if config.get('database', 'replicas').strip() != '':
+        _replica_lag = config.getint('database', 'replica_sticky_seconds')
+
+    backend = config.get('cache', 'backend')
+    max_bytes = config.getint('cache', 'max_bytes')
+    shared_dir = app.config.get_path(config.get('cache', 'shared_dir'))
+    versions_path = os.path.join(shared_dir, 'versions')
+
+    if backend == 'memory':
+        _backend = MemoryBackend(max_bytes, versions_path)
+    elif backend == 'shared':
+        store_path = os.path.join(shared_dir, 'store')
+        _backend = SharedMemoryBackend(store_path, max_bytes, versions_path)
+    elif backend == 'memcached':
+        servers = config.get('cache', 'memcached_servers').split(',')
+        servers = [server.strip() for server in servers]
+        ttl = config.getint('cache', 'memcached_ttl')
+        _backend = MemcachedBackend(servers, ttl)
+    else:
+        raise ValueError('Invalid cache backend: %s' % backend)
+
+
+def invalidate(*entities, bumped=None):
+    '''
+    Mark all cached responses that depend on `entities` as stale, in every
+    process that shares this cache configuration.
+
+    When read replicas are configured, a request that misses the cache right
+    after a write may read from a replica that has not caught up yet and
+    cache a stale response under the new versions. So the versions are
+    bumped again once replicas should have caught up.
+
+    If `bumped` is given, it is called after each bump with the versions of
+    `entities` before and after the bump.
+    '''
+
+    if _backend is not None:
+        _bump(entities, bumped)
+
+        if _replica_lag > 0:
+            timer = threading.Timer(_replica_lag, _bump, [entities, bumped])
+            timer.daemon = True
+            timer.start()
+
+
+def _bump(entities, bumped):
+    ''' Bump the versions of `entities` and report them to `bumped`. '''
+
+    if bumped is None:
+        _backend.bump_versions(entities)
+    else:
+        before = _backend.get_versions(entities)
+        _backend.bump_versions(entities)
+        bumped(before, _backend.get_versions(entities))
+
+
+def _cache_stream(key, header, chunks):
+    '''
+    Yield the chunks of a streamed response and cache the complete body after
+    the last chunk, unless it is larger than MAX_STREAMED_BYTES.
+    '''
+
+    entry = [header]
+    size = 0
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf8')
+
+            if entry is not None:
+                size += len(chunk)
+
+                if size <= MAX_STREAMED_BYTES:
+                    entry.append(chunk)
+                else:
+                    entry = None
+
+            yield chunk
+    finally:
+        # Close the original stream (and its request context) even if the
+        # client disconnects before the end.
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    if entry is not None:
+        _backend.set(key, b''.join(entry))
@@ -0,0 +1,611 @@
+'''
+Storage backends for the response cache (see app.cache).
+
+A backend stores opaque byte strings under string keys and also keeps the
+entity version counters that cached entries depend on. Version counters are
+always shared by every process that uses the same backend configuration, so
+an invalidation issued by one process is seen by all of them:
+
+ * MemoryBackend keeps entries in a per-process LRU and keeps versions in a
+   small memory mapped file that all processes on the host share.
+ * SharedMemoryBackend keeps entries and versions in memory mapped files, so
+   all processes on the host share one cache.
+ * MemcachedBackend keeps entries and versions in memcached, so processes on
+   any number of hosts share one cache.
+'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    ''' Base class for cache backends. '''
+
+    def __init__(self):
+        ''' Constructor. '''
+
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bump_versions(self, entities):
+        ''' Increment the version of each entity in `entities`. '''
+
+        raise NotImplementedError()
+
+    def get(self, key):
+        ''' Return the bytes stored under `key`, or None. '''
+
+        raise NotImplementedError()
+
+    def get_versions(self, entities):
+        ''' Return a tuple of the current versions of `entities`. '''
+
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        ''' Store `value` (bytes) under `key`. '''
+
+        raise NotImplementedError()
+
+    def stats(self):
+        ''' Return a dictionary of statistics for this process. '''
+
+        with self._stats_lock:
+            requests = self.hits + self.misses
+
+            return {
+                'backend': self.__class__.__name__,
+                'hitRatio': self.hits / requests if requests else None,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _count(self, hit):
+        ''' Record a cache hit or miss. '''
+
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class SharedVersions:
+    '''
+    A table of 64-bit version counters in a memory mapped file.
+
+    Entities are hashed into a fixed number of slots. Two entities that share a
+    slot invalidate each other, which costs a cache miss but is never stale.
+    Reads do not take a lock. Increments are serialized with a file lock (and
+    a thread lock, since file locks do not exclude threads of one process).
+    '''
+
+    SLOT = struct.Struct('<Q')
+
+    def __init__(self, path, slots=65536):
+        ''' Constructor. '''
+
+        self._lock = threading.Lock()
+        self._slots = slots
+        self._file = _open_mapped_file(path)
+        self._map = _map_file(self._file, slots * self.SLOT.size)
+
+    def bump(self, entities):
+        ''' Increment the counters for `entities`. '''
+
+        with self._lock, _file_lock(self._file):
+            for entity in entities:
+                offset = self._offset(entity)
+                version = self.SLOT.unpack_from(self._map, offset)[0]
+                self.SLOT.pack_into(self._map, offset, version + 1)
+
+    def get(self, entities):
+        ''' Return a tuple of the counters for `entities`. '''
+
+        unpack_from = self.SLOT.unpack_from
+
+        return tuple(
+            unpack_from(self._map, self._offset(entity))[0]
+            for entity in entities
+        )
+
+    def _offset(self, entity):
+        ''' Return the byte offset of an entity's slot. '''
+
+        return (zlib.crc32(entity.encode('utf8')) % self._slots) \
+               * self.SLOT.size
+
+
+class MemoryBackend(CacheBackend):
+    '''
+    An LRU cache in this process's memory with a budget in bytes.
+
+    Versions are kept in a SharedVersions table so that invalidations reach
+    every process on the host.
+    '''
+
+    def __init__(self, max_bytes, versions_path):
+        ''' Constructor. '''
+
+        super().__init__()
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._versions = SharedVersions(versions_path)
+        self.bytes = 0
+        self.evictions = 0
+
+    def bump_versions(self, entities):
+        ''' Increment the version of each entity in `entities`. '''
+
+        self._versions.bump(entities)
+
+    def get(self, key):
+        ''' Return the bytes stored under `key`, or None. '''
+
+        with self._lock:
+            value = self._entries.get(key)
+
+            if value is not None:
+                self._entries.move_to_end(key)
+
+        self._count(value is not None)
+
+        return value
+
+    def get_versions(self, entities):
+        ''' Return a tuple of the current versions of `entities`. '''
+
+        return self._versions.get(entities)
+
+    def set(self, key, value):
+        ''' Store `value`, evicting least recently used entries if needed. '''
+
+        if len(value) > self._max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+
+            if old is not None:
+                self.bytes -= len(old)
+
+            self._entries[key] = value
+            self.bytes += len(value)
+
+            while self.bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        ''' Return a dictionary of statistics for this process. '''
+
+        stats = super().stats()
+
+        with self._lock:
+            stats['bytes'] = self.bytes
+            stats['entries'] = len(self._entries)
+            stats['evictions'] = self.evictions
+            stats['maxBytes'] = self._max_bytes
+
+        return stats
+
+
+class SharedMemoryBackend(CacheBackend):
+    '''
+    A cache that all processes on a host share through a memory mapped file.
+
+    The file holds a hash table of buckets followed by a ring buffer of entry
+    data. New entries are appended at the head of the ring, overwriting the
+    oldest data, so eviction is first-in-first-out. A bucket refers to its
+    entry by absolute position in the ring; the entry is still valid if the
+    head has not advanced more than one lap past it.
+
+    Writers serialize on a file lock. Readers do not lock: they verify a CRC
+    of the data they copied and check that the head did not lap the entry
+    while they were reading.
+    '''
+
+    HEADER = struct.Struct('<8sQQQ')
+    BUCKET = struct.Struct('<16sQII')
+    MAGIC = b'NSACACHE'
+
+    def __init__(self, path, max_bytes, versions_path, buckets=65536):
+        ''' Constructor. '''
+
+        super().__init__()
+
+        self._buckets = buckets
+        self._data_start = self.HEADER.size + buckets * self.BUCKET.size
+        self._data_size = max_bytes
+        self._lock = threading.Lock()
+        self._file = _open_mapped_file(path)
+        self._map = _map_file(self._file, self._data_start + max_bytes)
+        self._versions = SharedVersions(versions_path)
+
+        with _file_lock(self._file):
+            magic, _, buckets_, data_size = \
+                self.HEADER.unpack_from(self._map, 0)
+
+            if magic != self.MAGIC or buckets_ != buckets or \
+               data_size != max_bytes:
+                self._map[:self._data_start] = bytes(self._data_start)
+                header = (self.MAGIC, 0, buckets, max_bytes)
+                self.HEADER.pack_into(self._map, 0, *header)
+
+    def bump_versions(self, entities):
+        ''' Increment the version of each entity in `entities`. '''
+
+        self._versions.bump(entities)
+
+    def get(self, key):
+        ''' Return the bytes stored under `key`, or None. '''
+
+        value = self._get(key)
+        self._count(value is not None)
+
+        return value
+
+    def get_versions(self, entities):
+        ''' Return a tuple of the current versions of `entities`. '''
+
+        return self._versions.get(entities)
+
+    def set(self, key, value):
+        ''' Store `value` (bytes) under `key`. '''
+
+        length = len(value)
+
+        # Large entries would flush most of the ring.
+        if length > self._data_size // 4:
+            return
+
+        digest, bucket_offset = self._locate(key)
+
+        with self._lock, _file_lock(self._file):
+            head = self._get_head()
+            start = head % self._data_size
+
+            if start + length > self._data_size:
+                # Skip the tail end of the ring so that entries are contiguous.
+                head += self._data_size - start
+                start = 0
+
+            # Advance the head before writing, so that a reader copying an
+            # entry that is about to be overwritten will notice.
+            self._set_head(head + length)
+
+            data_offset = self._data_start + start
+            self._map[data_offset:data_offset + length] = value
+
+            bucket = (digest, head, length, zlib.crc32(value))
+            self.BUCKET.pack_into(self._map, bucket_offset, *bucket)
+
+    def _get(self, key):
+        ''' Read an entry without locking. '''
+
+        digest, bucket_offset = self._locate(key)
+        digest_, position, length, crc = \
+            self.BUCKET.unpack_from(self._map, bucket_offset)
+
+        if digest_ != digest or not self._is_live(position):
+            return None
+
+        data_offset = self._data_start + position % self._data_size
+        value = self._map[data_offset:data_offset + length]
+
+        if zlib.crc32(value) != crc or not self._is_live(position):
+            return None
+
+        return value
+
+    def _get_head(self):
+        ''' Return the absolute write position of the ring. '''
+
+        return self.HEADER.unpack_from(self._map, 0)[1]
+
+    def _is_live(self, position):
+        ''' Return True if the entry at `position` has not been overwritten. '''
+
+        return self._get_head() - position <= self._data_size
+
+    def _locate(self, key):
+        ''' Return a key's digest and the byte offset of its bucket. '''
+
+        digest = hashlib.md5(key.encode('utf8')).digest()
+        bucket = int.from_bytes(digest[:8], 'little') % self._buckets
+
+        return digest, self.HEADER.size + bucket * self.BUCKET.size
+
+    def _set_head(self, head):
+        ''' Update the absolute write position of the ring. '''
+
+        struct.pack_into('<Q', self._map, 8, head)
+
+
+class MemcachedBackend(CacheBackend):
+    '''
+    A client for one or more servers that speak the memcached text protocol.
+
+    Keys are distributed over servers by hash. Each thread keeps its own
+    connections. Network errors are logged and treated as cache misses, so an
+    unavailable server degrades performance but not correctness; entries also
+    expire after `ttl` seconds to bound staleness if an invalidation is lost.
+    '''
+
+    def __init__(self, servers, ttl, prefix='nsa-codenames:', timeout=0.5):
+        ''' Constructor. '''
+
+        super().__init__()
+
+        self._last_versions = dict()
+        self._local = threading.local()
+        self._prefix = prefix
+        self._servers = servers
+        self._timeout = timeout
+        self._ttl = ttl
+
+    def bump_versions(self, entities):
+        ''' Increment the version of each entity in `entities`. '''
+
+        for entity in entities:
+            key = self._key('version:' + entity)
+
+            try:
+                if self._command(key, 'incr %s 1' % key) == b'NOT_FOUND':
+                    # Start a new counter, then increment it so that it
+                    # differs from a counter started in the same millisecond.
+                    self._add_version(key)
+                    self._command(key, 'incr %s 1' % key)
+            except (OSError, MemcachedError) as e:
+                logger.error('Unable to invalidate "%s": %s' % (entity, e))
+
+    def get(self, key):
+        ''' Return the bytes stored under `key`, or None. '''
+
+        try:
+            value = self._get_multi([self._key(key)]).get(self._key(key))
+        except (OSError, MemcachedError) as e:
+            logger.warning('Memcached get failed: %s' % e)
+            value = None
+
+        self._count(value is not None)
+
+        return value
+
+    def get_versions(self, entities):
+        ''' Return a tuple of the current versions of `entities`. '''
+
+        keys = [self._key('version:' + entity) for entity in entities]
+
+        try:
+            values = self._get_multi(keys)
+
+            for key in keys:
+                if key not in values:
+                    values[key] = self._add_version(key)
+        except (OSError, MemcachedError) as e:
+            # Entries can't be read or written either, so keep reporting the
+            # last known versions (or -1, which is never a real version), so
+            # that callers that compare versions (such as the typeahead
+            # index) don't see a change on every call.
+            logger.warning('Memcached get failed: %s' % e)
+            return tuple(self._last_versions.get(key, -1) for key in keys)
+
+        versions = tuple(int(values[key]) for key in keys)
+        self._last_versions.update(zip(keys, versions))
+
+        return versions
+
+    def set(self, key, value):
+        ''' Store `value` (bytes) under `key`. '''
+
+        key = self._key(key)
+        command = 'set %s 0 %d %d' % (key, self._ttl, len(value))
+
+        try:
+            self._command(key, command, value)
+        except (OSError, MemcachedError) as e:
+            logger.warning('Memcached set failed: %s' % e)
+
+    def _add_version(self, key):
+        '''
+        Initialize a missing version counter and return its value.
+
+        The counter starts at the current time rather than 0 so that, if
+        memcached evicts a counter, entries cached under its old values are not
+        resurrected.
+        '''
+
+        value = str(int(time.time() * 1000)).encode('ascii')
+        command = 'add %s 0 0 %d' % (key, len(value))
+
+        if self._command(key, command, value) == b'NOT_STORED':
+            # Another process initialized it first.
+            return self._get_multi([key]).get(key, value)
+
+        return value
+
+    def _command(self, key, command, data=None):
+        ''' Send a storage or incr command and return the response line. '''
+
+        connection = self._connect(key)
+
+        try:
+            connection.write(command.encode('ascii') + b'\r\n')
+
+            if data is not None:
+                connection.write(data + b'\r\n')
+
+            connection.flush()
+            response = connection.readline().rstrip(b'\r\n')
+        except OSError:
+            self._disconnect(key)
+            raise
+
+        if response.startswith((b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR')):
+            raise MemcachedError(response.decode('ascii', 'replace'))
+
+        return response
+
+    def _connect(self, key):
+        ''' Return this thread's connection to the server for `key`. '''
+
+        server = self._server(key)
+        connections = self._local.__dict__.setdefault('connections', {})
+
+        if server not in connections:
+            host, port = server.rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)), self._timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections[server] = sock.makefile('rwb')
+
+        return connections[server]
+
+    def _disconnect(self, key):
+        ''' Drop this thread's connection to the server for `key`. '''
+
+        connections = self._local.__dict__.get('connections', {})
+        connection = connections.pop(self._server(key), None)
+
+        if connection is not None:
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    def _get_multi(self, keys):
+        '''
+        Fetch several keys and return a dictionary of the ones that were found.
+        '''
+
+        by_server = dict()
+        values = dict()
+
+        for key in keys:
+            by_server.setdefault(self._server(key), list()).append(key)
+
+        for server_keys in by_server.values():
+            values.update(self._get_from_server(server_keys))
+
+        return values
+
+    def _get_from_server(self, keys):
+        '''
+        Fetch several keys that all live on the same server and return a
+        dictionary of the ones that were found.
+        '''
+
+        connection = self._connect(keys[0])
+        values = dict()
+
+        try:
+            connection.write(('get %s\r\n' % ' '.join(keys)).encode('ascii'))
+            connection.flush()
+
+            while True:
+                line = connection.readline().rstrip(b'\r\n')
+
+                if line == b'END':
+                    break
+
+                if not line.startswith(b'VALUE '):
+                    raise MemcachedError(line.decode('ascii', 'replace'))
+
+                _, key, _, length = line.split(b' ')[:4]
+                value = connection.read(int(length) + 2)[:-2]
+                values[key.decode('ascii')] = value
+        except OSError:
+            self._disconnect(keys[0])
+            raise
+
+        return values
+
+    def _key(self, key):
+        ''' Convert a cache key into a short, memcached safe key. '''
+
+        return self._prefix + hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _server(self, key):
+        ''' Return the server responsible for a (converted) key. '''
+
+        if len(self._servers) == 1:
+            return self._servers[0]
+
+        return self._servers[zlib.crc32(key.encode('ascii'))
+                             % len(self._servers)]
+
+
+class MemcachedError(Exception):
+    ''' The memcached server returned an error. '''
+
+
+@contextmanager
+def _file_lock(file_):
+    ''' Hold an exclusive lock on an open file. '''
+
+    fcntl.flock(file_.fileno(), fcntl.LOCK_EX)
+
+    try:
+        yield
+    finally:
+        fcntl.flock(file_.fileno(), fcntl.LOCK_UN)
+
+
+def _give_to_parent_owner(path):
+    ''' If running as root, chown `path` to the owner of its parent. '''
+
+    if os.geteuid() == 0:
+        parent = os.stat(os.path.dirname(os.path.abspath(path)))
+        os.chown(path, parent.st_uid, parent.st_gid)
+
+
+def _map_file(file_, size):
+    ''' Grow a file to `size` bytes (if necessary) and memory map it. '''
+
+    with _file_lock(file_):
+        if os.fstat(file_.fileno()).st_size < size:
+            os.ftruncate(file_.fileno(), size)
+
+    return mmap.mmap(file_.fileno(), size)
+
+
+def _open_mapped_file(path):
+    '''
+    Open (creating if necessary) a file that will be memory mapped.
+
+    Command line tools such as bin/user.py may run as root. New files and
+    directories are given to the owner of the directory that contains them
+    (the web user, see install.bash), so that the web processes can open them
+    no matter who created them.
+    '''
+
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+        _give_to_parent_owner(directory)
+
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o660)
+    except FileExistsError:
+        fd = os.open(path, os.O_RDWR)
+    else:
+        _give_to_parent_owner(path)
+
+    return os.fdopen(fd, 'r+b')
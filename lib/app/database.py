@@ -1,36 +1,241 @@
+from configparser import ConfigParser
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from urllib.parse import quote
+
 import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.orm import sessionmaker
 
+import app.config
+
+# Pragmas for every SQLite connection: durable at transaction boundaries in
+# WAL mode, enforce foreign keys like InnoDB does, wait for locks instead of
+# failing, and use a 64 MiB page cache and 256 MiB of memory mapped I/O.
+SQLITE_PRAGMAS = (
+    'synchronous = NORMAL',
+    'foreign_keys = ON',
+    'busy_timeout = 5000',
+    'cache_size = -65536',
+    'mmap_size = 268435456',
+    'temp_store = MEMORY',
+)
+
+_checkouts = dict()
+_checkouts_lock = threading.Lock()
 _engine = None
+_replica_engines = None
+_replica_lock = threading.Lock()
+_replica_turn = 0
 _sessionmaker = None
 
 
+class PoolMetrics:
+    '''
+    Counters that describe how a connection pool is being used.
+
+    These are updated by pool event listeners (see `_listen_pool_events()`)
+    and by MeteredQueuePool, which times how long checkouts wait for a free
+    connection. One instance counts the pools of all engines in a process.
+    '''
+
+    def __init__(self):
+        ''' Constructor. '''
+
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.overflow_checkouts = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def add(self, counter, amount=1):
+        ''' Increment a counter. '''
+
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def add_wait(self, seconds, timed_out):
+        ''' Record the time spent waiting for a connection. '''
+
+        with self._lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        ''' Return a copy of the counters. '''
+
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'overflowCheckouts': self.overflow_checkouts,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'waitSeconds': self.wait_seconds,
+                'maxWaitSeconds': self.max_wait_seconds,
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    ''' A QueuePool that measures how long callers wait for a connection. '''
+
+    def _do_get(self):
+        ''' Get a connection from the pool, recording the wait time. '''
+
+        start = time.monotonic()
+        timed_out = False
+
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            _pool_metrics.add_wait(time.monotonic() - start, timed_out)
+
+
+_pool_metrics = PoolMetrics()
+
+
+def enable_leak_detection(engine):
+    '''
+    Record the thread and stack trace of every connection checked out of
+    `engine`'s pool, so that `get_checkouts()` can report connections that
+    are held for longer than expected.
+
+    Formatting a stack trace on every checkout is not free, so this is meant
+    for debugging.
+    '''
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        stack = ''.join(traceback.format_stack())
+        checkout = (threading.get_ident(), time.monotonic(), stack)
+
+        with _checkouts_lock:
+            _checkouts[id(connection_record)] = checkout
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        with _checkouts_lock:
+            _checkouts.pop(id(connection_record), None)
+
+
 def get_engine(config, super_user=False):
     '''
     Get a SQLAlchemy engine from a configuration object.
 
+    The database is selected by the ``url`` option if it is set, and
+    otherwise by ``driver``: "mysql" connects to ``database`` on ``host``, and
+    "sqlite" opens the file at ``sqlite_path``. SQLite databases use WAL mode
+    and the pragmas in SQLITE_PRAGMAS. If ``read_only`` is set, then
+    connections cannot modify the database.
+
     If ``super_user`` is True, then connect as super user -- typically reserved
-    for issuing DDL statements.
+    for issuing DDL statements. (This does not apply to SQLite.)
     '''
 
     global _engine
 
     if _engine is None:
-        if super_user:
-            connect_string = 'mysql+pymysql://%(super_username)s' \
-                             ':%(super_password)s@%(host)s/%(database)s?'
-        else:
-            connect_string = 'mysql+pymysql://%(username)s:%(password)s' \
-                             '@%(host)s/%(database)s'
-
-        _engine = sqlalchemy.create_engine(
-            connect_string % config,
-            pool_recycle=3600
-        )
+        url = _get_url(config, super_user)
+        read_only = _get_boolean(config['read_only'])
+        _engine = _create_engine(url, config, read_only)
 
     return _engine
 
 
+def get_pool_stats():
+    '''
+    Return statistics about this process's connection pools, or None if the
+    database has not been used yet.
+
+    The counters include the pools of the primary and of all replicas.
+    '''
+
+    if _engine is None:
+        return None
+
+    stats = {'pid': os.getpid()}
+    stats.update(_get_pool_state(_engine.pool))
+    stats.update(_pool_metrics.as_dict())
+
+    if _replica_engines:
+        stats['replicas'] = [
+            _get_pool_state(engine.pool) for engine in _replica_engines
+        ]
+
+    return stats
+
+
+def get_replica_engine(config):
+    '''
+    Get an engine for one of the read replicas listed in the ``replicas``
+    option, taking turns between them, or None if there are no replicas.
+
+    Replica connections are always read-only.
+    '''
+
+    global _replica_turn
+
+    engines = get_replica_engines(config)
+
+    if not engines:
+        return None
+
+    with _replica_lock:
+        _replica_turn = (_replica_turn + 1) % len(engines)
+        return engines[_replica_turn]
+
+
+def get_replica_engines(config):
+    ''' Get engines for all read replicas in the ``replicas`` option. '''
+
+    global _replica_engines
+
+    with _replica_lock:
+        if _replica_engines is None:
+            urls = [url.strip() for url in config['replicas'].split(',')]
+            _replica_engines = [
+                _create_engine(url, config, read_only=True)
+                for url in urls if url != ''
+            ]
+
+    return _replica_engines
+
+
+def get_checkouts(thread_id):
+    '''
+    Return (age in seconds, stack trace) for each connection that the thread
+    with ident `thread_id` currently has checked out.
+
+    This is always empty unless `enable_leak_detection()` was called.
+    '''
+
+    now = time.monotonic()
+
+    with _checkouts_lock:
+        return [
+            (now - checked_out, stack)
+            for owner, checked_out, stack in _checkouts.values()
+            if owner == thread_id
+        ]
+
+
 def get_session(engine):
     ''' Get a SQLAlchemy session. '''
 
@@ -40,3 +245,167 @@ def get_session(engine):
         _sessionmaker = sessionmaker()
 
     return _sessionmaker(bind=engine)
+
+
+def _create_engine(url, config, read_only):
+    ''' Create an engine for `url` and collect metrics from its pool. '''
+
+    if make_url(url).drivername.split('+')[0] == 'sqlite':
+        engine = _create_sqlite_engine(url, config, read_only)
+    else:
+        engine = _create_server_engine(url, config, read_only)
+
+    _listen_pool_events(engine)
+
+    return engine
+
+
+def _create_server_engine(url, config, read_only):
+    ''' Create an engine for a database server, such as MySQL. '''
+
+    engine = sqlalchemy.create_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=int(config['pool_size']),
+        max_overflow=int(config['max_overflow']),
+        pool_timeout=int(config['pool_timeout']),
+        pool_recycle=int(config['pool_recycle']),
+        pool_pre_ping=_get_boolean(config['pool_pre_ping'])
+    )
+
+    if read_only:
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SET SESSION TRANSACTION READ ONLY')
+            cursor.close()
+
+    return engine
+
+
+def _create_sqlite_engine(url, config, read_only):
+    '''
+    Create an engine for a SQLite database.
+
+    Connections are created here instead of by SQLAlchemy so that the file can
+    be opened read-only (which needs a URI filename) and shared between
+    threads through the pool. An in-memory database has a single connection.
+    '''
+
+    path = make_url(url).database
+
+    if path in (None, '', ':memory:'):
+        connect = lambda: sqlite3.connect(':memory:', check_same_thread=False)
+        engine = sqlalchemy.create_engine(
+            'sqlite://',
+            creator=connect,
+            poolclass=StaticPool
+        )
+    else:
+        if read_only:
+            uri = 'file:%s?mode=ro' % quote(os.path.abspath(path))
+            connect = lambda: sqlite3.connect(
+                uri,
+                uri=True,
+                check_same_thread=False
+            )
+        else:
+            connect = lambda: sqlite3.connect(path, check_same_thread=False)
+
+        engine = sqlalchemy.create_engine(
+            'sqlite://',
+            creator=connect,
+            poolclass=MeteredQueuePool,
+            pool_size=int(config['pool_size']),
+            max_overflow=int(config['max_overflow']),
+            pool_timeout=int(config['pool_timeout'])
+        )
+
+    @event.listens_for(engine, 'connect')
+    def connect_sqlite(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        # WAL lets readers continue while a write is in progress. The journal
+        # mode is stored in the database file, so it is only set by writers.
+        if not read_only:
+            cursor.execute('PRAGMA journal_mode = WAL')
+
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA ' + pragma)
+
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+
+        cursor.close()
+
+    return engine
+
+
+def _get_boolean(value):
+    ''' Convert a boolean config value such as "yes" or "off" to a bool. '''
+
+    return ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
+def _get_pool_state(pool):
+    ''' Return the current size and usage of a pool. '''
+
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    return {
+        'size': pool.size(),
+        'checkedIn': pool.checkedin(),
+        'checkedOut': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'maxOverflow': pool._max_overflow,
+        'timeout': pool.timeout(),
+    }
+
+
+def _get_url(config, super_user):
+    ''' Return the URL of the configured database. '''
+
+    if config.get('url'):
+        return config['url']
+
+    driver = config['driver']
+
+    if driver == 'mysql':
+        if super_user:
+            connect_string = 'mysql+pymysql://%(super_username)s' \
+                             ':%(super_password)s@%(host)s/%(database)s?'
+        else:
+            connect_string = 'mysql+pymysql://%(username)s:%(password)s' \
+                             '@%(host)s/%(database)s'
+
+        return connect_string % config
+    elif driver == 'sqlite':
+        return 'sqlite:///' + app.config.get_path(config['sqlite_path'])
+    else:
+        raise ValueError('Invalid database driver: %s' % driver)
+
+
+def _listen_pool_events(engine):
+    ''' Update the pool metrics from `engine`'s pool events. '''
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        _pool_metrics.add('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        _pool_metrics.add('checkouts')
+
+        # Only a QueuePool (not e.g. the StaticPool of an in-memory SQLite
+        # database) has overflow connections.
+        if isinstance(engine.pool, QueuePool) and engine.pool.overflow() > 0:
+            _pool_metrics.add('overflow_checkouts')
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        _pool_metrics.add('checkins')
+
+    @event.listens_for(engine, 'invalidate')
+    def invalidate(dbapi_connection, connection_record, exception):
+        _pool_metrics.add('invalidations')
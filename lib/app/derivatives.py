@@ -0,0 +1,228 @@
+'''
+Resized and re-encoded copies ("derivatives") of codename images.
+
+Derivatives are generated the first time they are requested and stored in a
+size bounded cache directory (`data/derivatives`). When the cache grows past
+its budget, the least recently used files are evicted. The total size is kept
+in a counter file that all processes on the host share, so the budget applies
+to the directory rather than to each process. Derivatives are named
+after the hash of their source image, so they never go stale and an evicted
+derivative is simply generated again on its next request.
+'''
+
+from contextlib import contextmanager
+import fcntl
+import os
+import tempfile
+import threading
+
+from PIL import Image as PILImage
+
+import app.config
+
+# Named sizes (width, height). All of them keep the 720x400 aspect ratio of
+# uploaded images.
+SIZES = {
+    'thumb': (144, 80),
+    'small': (360, 200),
+    'medium': (540, 300),
+    'large': (720, 400),
+}
+
+# Output formats: (Pillow format, MIME type).
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+# When the cache is over budget, evict files until it is this fraction full.
+EVICT_TO = 0.9
+
+# The name of the counter file in the cache directory.
+SIZE_FILE = '.size'
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class DerivativeCache:
+    ''' A size bounded directory of derivatives with LRU eviction. '''
+
+    def __init__(self, data_dir, subdir, max_bytes):
+        ''' Constructor. '''
+
+        self._data_dir = data_dir
+        self._subdir = subdir
+        self._root = os.path.join(data_dir, subdir)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+    def get(self, source_path, size, format_):
+        '''
+        Return the path (relative to the data directory) of a derivative of
+        the image stored at `source_path`, generating it if necessary.
+        '''
+
+        hash_ = source_path.replace(os.sep, '')
+        name = '%s-%s.%s' % (hash_[2:], size, format_)
+        rel_path = os.path.join(self._subdir, hash_[0], hash_[1], name)
+        path = os.path.join(self._data_dir, rel_path)
+
+        # Touching the file on every hit is what makes eviction LRU.
+        try:
+            os.utime(path, None)
+            return rel_path
+        except FileNotFoundError:
+            pass
+
+        with self._key_lock(rel_path):
+            if os.path.exists(path):
+                return rel_path
+
+            source = os.path.join(self._data_dir, source_path)
+            nbytes = self._generate(source, path, size, format_)
+
+        self._add_bytes(nbytes)
+
+        return rel_path
+
+    def _add_bytes(self, nbytes):
+        '''
+        Account for a new file and evict old files if over budget.
+
+        The counter file is updated under an exclusive file lock, which also
+        serializes threads: each call opens the file separately.
+        '''
+
+        size_path = os.path.join(self._root, SIZE_FILE)
+        fd = os.open(size_path, os.O_RDWR | os.O_CREAT, 0o660)
+
+        with os.fdopen(fd, 'r+') as size_file:
+            fcntl.flock(size_file.fileno(), fcntl.LOCK_EX)
+            text = size_file.read().strip()
+
+            if text == '':
+                # The new file is included in the scan.
+                size = sum(size for _, size, _ in self._scan())
+            else:
+                size = int(text) + nbytes
+
+            if size > self._max_bytes:
+                size = self._evict()
+
+            size_file.seek(0)
+            size_file.truncate()
+            size_file.write(str(size))
+
+    def _evict(self):
+        '''
+        Remove least recently used files and return the size of the remaining
+        files. The caller must hold the counter file's lock.
+        '''
+
+        files = sorted(self._scan(), key=lambda file_: file_[2])
+        target = self._max_bytes * EVICT_TO
+        total = sum(size for _, size, _ in files)
+
+        for path, size, _ in files:
+            if total <= target:
+                break
+
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+        return total
+
+    def _generate(self, source, path, size, format_):
+        '''
+        Write a derivative of `source` to `path` and return its size.
+
+        The file is written under a temporary name and renamed into place, so
+        readers never see a partial file and two processes generating the same
+        derivative at once is harmless.
+        '''
+
+        pil_format, _ = FORMATS[format_]
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        with PILImage.open(source) as image:
+            image.thumbnail(SIZES[size], PILImage.LANCZOS)
+
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+            try:
+                with os.fdopen(fd, 'wb') as temp:
+                    image.save(temp, format=pil_format)
+
+                os.replace(temp_path, path)
+            except:
+                os.unlink(temp_path)
+                raise
+
+        return os.path.getsize(path)
+
+    @contextmanager
+    def _key_lock(self, key):
+        '''
+        Hold a lock that is specific to `key`, so that concurrent requests for
+        the same derivative only generate it once.
+        '''
+
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    def _scan(self):
+        ''' Yield (path, size, mtime) for every file in the cache. '''
+
+        for dir_path, _, file_names in os.walk(self._root):
+            for file_name in file_names:
+                if file_name.endswith('.tmp') or file_name == SIZE_FILE:
+                    continue
+
+                path = os.path.join(dir_path, file_name)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                yield path, stat.st_size, stat.st_mtime
+
+
+def get_derivative(source_path, size, format_):
+    '''
+    Return the path (relative to the data directory) of the `size` and
+    `format_` derivative of the image stored at `source_path`, generating it
+    if necessary.
+    '''
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            config = app.config.get_config()
+            max_bytes = config.getint('images', 'derivative_cache_size')
+            data_dir = app.config.get_path('data')
+            _cache = DerivativeCache(data_dir, 'derivatives', max_bytes)
+
+    return _cache.get(source_path, size, format_)
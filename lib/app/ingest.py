@@ -0,0 +1,188 @@
+'''
+Receive uploaded images and process them in a pool of worker processes.
+
+The request spools the raw upload to the `incoming` directory while hashing it
+(`spool_upload()`), moves it into the data directory, creates an Image row that
+is not ready, and calls `submit()`. Decoding and thumbnailing is CPU bound, so
+it is done in a bounded process pool instead of in the request. When a worker
+finishes, the row is updated with the thumbnail path and flagged as ready.
+
+Jobs only live in memory. Images that were being processed when a web
+process exited, or when a worker process died (the pool is then replaced),
+stay not ready, and `bin/ingest.py` finishes them once their `queued` time is
+older than a lease. A job that fails because its image can't be processed
+deletes the image.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import app
+import app.cache
+import app.config
+import app.database
+from model import Image
+from model.image import store_thumbnail
+
+CHUNK_SIZE = 65536
+
+_executor = None
+_lock = threading.Lock()
+_slots = None
+_workers = None
+
+
+def acquire():
+    '''
+    Reserve a slot in the processing queue.
+
+    Returns False if too many uploads are already waiting to be processed.
+    Every successful call must be followed by `submit()` or `release()`.
+    '''
+
+    _init()
+    return _slots.acquire(blocking=False)
+
+
+def get_incoming_dir():
+    ''' Return the directory where raw uploads wait to be processed. '''
+
+    incoming_dir = app.config.get_path('data/incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+
+    return incoming_dir
+
+
+def release():
+    ''' Release a slot reserved with `acquire()` without submitting a job. '''
+
+    _slots.release()
+
+
+def spool_upload(stream, max_length):
+    '''
+    Copy an upload from `stream` to the incoming directory in chunks, hashing
+    it along the way.
+
+    Returns the path of the spooled file and the SHA-1 hash of its contents.
+    Raises RequestEntityTooLarge if the upload is longer than `max_length`.
+    '''
+
+    fd, upload_path = tempfile.mkstemp(dir=get_incoming_dir())
+    hash_ = hashlib.sha1()
+    length = 0
+
+    try:
+        with os.fdopen(fd, 'wb') as upload:
+            for chunk in iter(partial(stream.read, CHUNK_SIZE), b''):
+                length += len(chunk)
+
+                if length > max_length:
+                    raise RequestEntityTooLarge()
+
+                hash_.update(chunk)
+                upload.write(chunk)
+    except:
+        os.unlink(upload_path)
+        raise
+
+    return upload_path, hash_.hexdigest()
+
+
+def submit(image_id, rel_path):
+    '''
+    Generate a thumbnail for the (committed) Image row with the given ID,
+    whose file is stored at `rel_path` in the data directory. The caller must
+    hold a slot from `acquire()`, and still holds it if this raises.
+
+    If a worker process died, the process pool is replaced. (The jobs that
+    were running in the broken pool fail, and `_finish()` leaves their images
+    for bin/ingest.py.)
+    '''
+
+    global _executor
+
+    database_config = dict(app.config.get_config().items('database'))
+    start = time.monotonic()
+
+    with _lock:
+        try:
+            future = _executor.submit(store_thumbnail, rel_path)
+        except BrokenProcessPool:
+            app.flask_app.logger.warning('An image processing worker died.'
+                                         ' Replacing the process pool.')
+            _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=_workers)
+            future = _executor.submit(store_thumbnail, rel_path)
+
+    callback = partial(_finish, image_id, database_config, start)
+    future.add_done_callback(callback)
+
+
+def _finish(image_id, database_config, start, future):
+    '''
+    Record the result of processing an upload and release the job's queue
+    slot. This runs in a thread of the web process after the worker process
+    is done.
+    '''
+
+    app.flask_app.metrics['nsa_upload_processing_seconds'] \
+        .observe(time.monotonic() - start)
+
+    engine = app.database.get_engine(database_config)
+    session = app.database.get_session(engine)
+
+    try:
+        image = session.query(Image).filter(Image.id == image_id).first()
+
+        if image is None or image.ready:
+            # The image was deleted, or finished by bin/ingest.py, while it
+            # was being processed.
+            return
+
+        slug = image.codename.slug
+
+        try:
+            image.thumb_path = future.result()
+            image.ready = True
+        except BrokenProcessPool:
+            # The worker died, possibly because of another job. Leave the
+            # image for bin/ingest.py.
+            app.flask_app.logger.warning(
+                'Worker died while processing image %d.' % image_id
+            )
+            return
+        except Exception:
+            app.flask_app.logger.exception(
+                'Unable to process upload for image %d.' % image_id
+            )
+            session.delete(image)
+
+        session.commit()
+        app.cache.invalidate('codenames', 'codename:' + slug)
+    finally:
+        session.close()
+        _slots.release()
+
+
+def _init():
+    ''' Create the process pool the first time it is needed. '''
+
+    global _executor, _slots, _workers
+
+    with _lock:
+        if _executor is None:
+            config = app.config.get_config()
+            _workers = config.getint('images', 'ingest_workers') or None
+            queue_size = config.getint('images', 'ingest_queue_size')
+
+            _executor = ProcessPoolExecutor(max_workers=_workers)
+            _slots = threading.BoundedSemaphore(queue_size)
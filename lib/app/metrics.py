@@ -0,0 +1,456 @@
+'''
+Application metrics in the Prometheus text exposition format.
+
+Each process records samples in its own memory mapped file in the metrics
+directory, so recording a sample is a few memory writes under a thread lock
+and never waits for another process. `Registry.render()` reads the files of
+all processes and adds them up, so a scrape reports totals for every WSGI
+worker no matter which worker answers it.
+
+Samples from processes that have exited are still counted, so that counters
+never go backwards. Before rendering, the files of exited processes are added
+to one file of exited processes and deleted, so the directory doesn't grow
+each time a WSGI process is recycled. A lock file in the directory keeps
+renderers from reading a sample twice while it is being moved. The directory
+may be emptied whenever the application is restarted; Prometheus handles the
+counter reset.
+
+A registry without a directory records nothing. Command line tools use one so
+that their requests don't count as production traffic and their short lived
+processes don't leave sample files behind.
+'''
+
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+
+# Buckets for latencies (seconds).
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+# Buckets for response sizes (bytes).
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Buckets for small counts, such as SQL statements per request.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+INITIAL_SIZE = 65536
+
+# The file that samples of exited processes are added to.
+EXITED_FILE = 'exited.db'
+
+# The file that is locked while sample files are opened, merged, or read.
+LOCK_FILE = 'lock'
+
+# A sample file starts with the number of bytes in use, followed by records.
+# Each record is a length-prefixed key, padded to 8 bytes, and a double.
+_HEADER = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+class Counter:
+    ''' A metric that only goes up. '''
+
+    type_ = 'counter'
+
+    def __init__(self, registry, name, documentation):
+        ''' Constructor. '''
+
+        self.name = name
+        self.documentation = documentation
+        self._registry = registry
+
+    def inc(self, amount=1, **labels):
+        ''' Increment the counter for `labels`. '''
+
+        self._registry.add(self.name, labels, amount)
+
+
+class Histogram:
+    ''' A metric that counts observations in buckets. '''
+
+    type_ = 'histogram'
+
+    def __init__(self, registry, name, documentation, buckets):
+        ''' Constructor. '''
+
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(float(bucket) for bucket in buckets)
+        self._registry = registry
+
+    def observe(self, value, **labels):
+        '''
+        Record an observation for `labels`.
+
+        Buckets are stored individually and made cumulative when rendered,
+        so an observation only updates one bucket.
+        '''
+
+        index = bisect_left(self.buckets, value)
+
+        if index < len(self.buckets):
+            bucket = _format_value(self.buckets[index])
+        else:
+            bucket = '+Inf'
+
+        self._registry.add(self.name + '_bucket', dict(labels, le=bucket), 1)
+        self._registry.add(self.name + '_sum', labels, value)
+        self._registry.add(self.name + '_count', labels, 1)
+
+
+class Registry:
+    '''
+    A collection of metrics shared by all processes using `directory`. If
+    `directory` is None, then samples are discarded.
+    '''
+
+    def __init__(self, directory):
+        ''' Constructor. '''
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+        self._directory = directory
+        self._metrics = OrderedDict()
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._keys = dict()
+
+    def __getitem__(self, name):
+        ''' Return the metric called `name`. '''
+
+        return self._metrics[name]
+
+    def add(self, sample_name, labels, amount):
+        ''' Add `amount` to a sample in this process's file. '''
+
+        if self._directory is None:
+            return
+
+        cache_key = (sample_name, tuple(sorted(labels.items())))
+
+        try:
+            key = self._keys[cache_key]
+        except KeyError:
+            key = json.dumps([sample_name, labels], sort_keys=True)
+            self._keys[cache_key] = key
+
+        self._get_file().add(key, amount)
+
+    def counter(self, name, documentation):
+        ''' Create a counter. '''
+
+        counter = Counter(self, name, documentation)
+        self._metrics[name] = counter
+
+        return counter
+
+    def histogram(self, name, documentation, buckets=DURATION_BUCKETS):
+        ''' Create a histogram. '''
+
+        histogram = Histogram(self, name, documentation, buckets)
+        self._metrics[name] = histogram
+
+        return histogram
+
+    def render(self):
+        ''' Render the totals of all processes in Prometheus text format. '''
+
+        samples = defaultdict(dict)
+        records = list()
+
+        if self._directory is not None:
+            self._merge_exited()
+
+            with self._lock_directory(fcntl.LOCK_SH):
+                for file_name in os.listdir(self._directory):
+                    if file_name.endswith('.db'):
+                        path = os.path.join(self._directory, file_name)
+                        records.extend(_read_samples(path))
+
+        for key, value in records:
+            sample_name, labels = json.loads(key)
+            label_key = tuple(sorted(labels.items()))
+            totals = samples[sample_name]
+            totals[label_key] = totals.get(label_key, 0) + value
+
+        lines = list()
+
+        for metric in self._metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type_))
+
+            if metric.type_ == 'counter':
+                for labels, value in sorted(samples[metric.name].items()):
+                    lines.append(_format_sample(metric.name, labels, value))
+            else:
+                lines.extend(_render_histogram(metric, samples))
+
+        return '\n'.join(lines) + '\n'
+
+    def _get_file(self):
+        '''
+        Return this process's sample file, opening it if necessary. A forked
+        child process gets its own file.
+
+        The file is opened under a shared lock, so that a file left by an
+        exited process with the same PID is either merged before it is
+        opened, or seen to belong to a running process.
+        '''
+
+        pid = os.getpid()
+
+        with self._file_lock:
+            if self._file is None or self._file.pid != pid:
+                path = os.path.join(self._directory, '%d.db' % pid)
+
+                with self._lock_directory(fcntl.LOCK_SH):
+                    self._file = _SampleFile(path, pid)
+
+            return self._file
+
+    @contextmanager
+    def _lock_directory(self, operation):
+        ''' Hold the lock file with `operation` (shared or exclusive). '''
+
+        path = os.path.join(self._directory, LOCK_FILE)
+
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            yield
+
+    def _merge_exited(self):
+        '''
+        Add the samples in the files of exited processes to the file of
+        exited processes, then delete their files.
+        '''
+
+        with self._lock_directory(fcntl.LOCK_EX):
+            exited = None
+
+            for file_name in os.listdir(self._directory):
+                pid = _get_pid(file_name)
+
+                if pid is None or _is_running(pid):
+                    continue
+
+                if exited is None:
+                    path = os.path.join(self._directory, EXITED_FILE)
+                    exited = _SampleFile(path, None)
+
+                path = os.path.join(self._directory, file_name)
+
+                for key, value in _read_samples(path):
+                    exited.add(key, value)
+
+                os.unlink(path)
+
+            if exited is not None:
+                exited.close()
+
+
+class _SampleFile:
+    ''' A memory mapped file of samples that is written by one process. '''
+
+    def __init__(self, path, pid):
+        ''' Constructor. '''
+
+        self.pid = pid
+        self._lock = threading.Lock()
+        self._offsets = dict()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, 'r+b')
+
+        if os.fstat(fd).st_size == 0:
+            self._file.truncate(INITIAL_SIZE)
+
+        self._map = mmap.mmap(fd, os.fstat(fd).st_size)
+        self._used, = _HEADER.unpack_from(self._map, 0)
+
+        if self._used == 0:
+            self._used = _HEADER.size
+            _HEADER.pack_into(self._map, 0, self._used)
+
+        # A file left by an earlier process with the same PID is continued.
+        for key, offset in _iter_records(self._map, self._used):
+            self._offsets[key] = offset
+
+    def add(self, key, amount):
+        ''' Add `amount` to the value stored under `key`. '''
+
+        with self._lock:
+            offset = self._offsets.get(key)
+
+            if offset is None:
+                offset = self._allocate(key)
+
+            value, = _VALUE.unpack_from(self._map, offset)
+            _VALUE.pack_into(self._map, offset, value + amount)
+
+    def close(self):
+        ''' Close the file. '''
+
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+    def _allocate(self, key):
+        '''
+        Append a record for `key` and return the offset of its value. The
+        caller must hold the lock.
+
+        The record is written before the header is updated, so readers in
+        other processes never see a partial record.
+        '''
+
+        encoded = key.encode('utf8')
+        offset = _align(self._used + _LENGTH.size + len(encoded))
+        used = offset + _VALUE.size
+
+        if used > len(self._map):
+            size = len(self._map)
+
+            while size < used:
+                size *= 2
+
+            self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+
+        _LENGTH.pack_into(self._map, self._used, len(encoded))
+        start = self._used + _LENGTH.size
+        self._map[start:start + len(encoded)] = encoded
+        _VALUE.pack_into(self._map, offset, 0.0)
+
+        self._used = used
+        _HEADER.pack_into(self._map, 0, used)
+        self._offsets[key] = offset
+
+        return offset
+
+
+def _align(position):
+    ''' Round `position` up to a multiple of 8. '''
+
+    return (position + 7) & ~7
+
+
+def _escape(value):
+    ''' Escape a label value. '''
+
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_sample(name, labels, value):
+    ''' Format one line of output. '''
+
+    if labels:
+        pairs = ('%s="%s"' % (k, _escape(str(v))) for k, v in labels)
+        name = '%s{%s}' % (name, ','.join(pairs))
+
+    return '%s %s' % (name, _format_value(value))
+
+
+def _format_value(value):
+    ''' Format a number, dropping the fraction of whole numbers. '''
+
+    if float(value).is_integer():
+        return str(int(value))
+    else:
+        return repr(float(value))
+
+
+def _get_pid(file_name):
+    ''' Return the PID that a sample file belongs to, or None. '''
+
+    name, extension = os.path.splitext(file_name)
+
+    if extension == '.db' and name.isdigit():
+        return int(name)
+    else:
+        return None
+
+
+def _is_running(pid):
+    ''' Return True if process `pid` exists. '''
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _iter_records(buffer, used):
+    ''' Yield (key, value offset) for each record in a sample file. '''
+
+    position = _HEADER.size
+
+    while position < used:
+        length, = _LENGTH.unpack_from(buffer, position)
+        start = position + _LENGTH.size
+        key = bytes(buffer[start:start + length]).decode('utf8')
+        offset = _align(start + length)
+
+        yield key, offset
+
+        position = offset + _VALUE.size
+
+
+def _read_samples(path):
+    ''' Return a list of (key, value) for each sample in a sample file. '''
+
+    try:
+        with open(path, 'rb') as file_:
+            size = os.fstat(file_.fileno()).st_size
+
+            if size == 0:
+                return []
+
+            fileno = file_.fileno()
+
+            with mmap.mmap(fileno, size, access=mmap.ACCESS_READ) as map_:
+                used, = _HEADER.unpack_from(map_, 0)
+
+                return [
+                    (key, _VALUE.unpack_from(map_, offset)[0])
+                    for key, offset in _iter_records(map_, min(used, size))
+                ]
+    except FileNotFoundError:
+        return []
+
+
+def _render_histogram(histogram, samples):
+    ''' Yield the output lines for a histogram. '''
+
+    buckets = samples[histogram.name + '_bucket']
+    counts = samples[histogram.name + '_count']
+    sums = samples[histogram.name + '_sum']
+    bounds = [_format_value(bucket) for bucket in histogram.buckets]
+    bounds.append('+Inf')
+
+    for labels in sorted(counts.keys()):
+        cumulative = 0
+
+        for bound in bounds:
+            bucket_labels = tuple(sorted(labels + (('le', bound),)))
+            cumulative += buckets.get(bucket_labels, 0)
+            yield _format_sample(
+                histogram.name + '_bucket',
+                labels + (('le', bound),),
+                cumulative
+            )
+
+        yield _format_sample(histogram.name + '_sum', labels, sums[labels])
+        yield _format_sample(histogram.name + '_count', labels, counts[labels])
@@ -0,0 +1,66 @@
+'''
+A per-request SQL profiler.
+
+When enabled with `[profiler] enabled`, every SQL statement executed while
+handling a request is counted and timed. Statements are grouped by shape: the
+statement text with literals and lists of bind parameters collapsed, so the
+same query with different arguments is counted together. Several statements
+of the same shape in a single request usually indicate an N+1 query pattern.
+'''
+
+import re
+
+_WHITESPACE = re.compile(r'\s+')
+_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_PARAM = r'(?:%s|%\(\w+\)s|\?|:\w+)'
+_PARAM_LIST = re.compile(r'\(\s*{0}(?:\s*,\s*{0})*\s*\)'.format(_PARAM))
+
+
+class RequestProfile:
+    ''' Statistics about the SQL statements executed by one request. '''
+
+    def __init__(self):
+        ''' Constructor. '''
+
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = dict()
+
+    def add(self, statement, seconds):
+        ''' Record a statement that took `seconds` to execute. '''
+
+        self.count += 1
+        self.seconds += seconds
+
+        shape = get_shape(statement)
+        shape_stats = self.shapes.setdefault(shape, [0, 0.0])
+        shape_stats[0] += 1
+        shape_stats[1] += seconds
+
+    def get_repeated(self, threshold):
+        '''
+        Return (shape, count, seconds) for each statement shape that was
+        executed more than `threshold` times, most frequent first.
+        '''
+
+        repeated = [
+            (shape, count, seconds)
+            for shape, (count, seconds) in self.shapes.items()
+            if count > threshold
+        ]
+
+        repeated.sort(key=lambda item: item[1], reverse=True)
+
+        return repeated
+
+
+def get_shape(statement):
+    ''' Normalize a SQL statement so that similar statements are equal. '''
+
+    shape = _STRING.sub('?', statement)
+    shape = _NUMBER.sub('?', shape)
+    shape = _PARAM_LIST.sub('(...)', shape)
+    shape = _WHITESPACE.sub(' ', shape)
+
+    return shape.strip()
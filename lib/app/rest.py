@@ -1,14 +1,111 @@
 ''' Utility functions for the REST API. '''
 
+import base64
+import binascii
 from datetime import datetime
+import itertools
+import json
 
-from flask import url_for as flask_url_for
+from flask import current_app, request, stream_with_context, \
+                  url_for as flask_url_for
+from werkzeug.exceptions import BadRequest
+
+# Streamed responses are sent in chunks of about this many bytes.
+STREAM_CHUNK_SIZE = 16384
 
 def date_to_timestamp(date_):
     ''' Python appallingly lacks a date -> epoch method. '''
 
     return (date_ - datetime.utcfromtimestamp(0)).total_seconds()
 
+def decode_cursor(cursor):
+    ''' Decode an opaque pagination cursor created by `encode_cursor()`. '''
+
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(cursor + padding).decode('utf8')
+    except (binascii.Error, UnicodeError, ValueError):
+        raise BadRequest('Invalid pagination cursor.')
+
+def encode_cursor(value):
+    '''
+    Encode a value (e.g. the sort key of the last item on a page) into an
+    opaque, URL-safe pagination cursor.
+    '''
+
+    cursor = base64.urlsafe_b64encode(str(value).encode('utf8'))
+    return cursor.decode('ascii').rstrip('=')
+
+def get_limit(default, maximum):
+    '''
+    Read the `limit` query parameter.
+
+    Returns `default` if the parameter is absent. Raises BadRequest if it is
+    not an integer between 1 and `maximum`.
+    '''
+
+    if 'limit' not in request.args:
+        return default
+
+    try:
+        limit = int(request.args['limit'])
+    except ValueError:
+        limit = 0
+
+    if not 1 <= limit <= maximum:
+        message = '`limit` must be an integer between 1 and %d.'
+        raise BadRequest(message % maximum)
+
+    return limit
+
+def stream_json(name, items, get_members):
+    '''
+    Return a response that streams a JSON object instead of building it in
+    memory first.
+
+    The object's `name` member is an array of `items`, which are encoded as
+    they are iterated, e.g. from a `yield_per()` query. `get_members` is
+    called after the last item and returns a dict of the object's other
+    members, so those may depend on the items, e.g. a "next page" URL.
+
+    The request context is kept until the stream ends, so `items` may use
+    `g.db` and `url_for()`. The first item is read before this returns, so
+    that the query runs (and its errors result in an error response) before
+    the response status is sent.
+    '''
+
+    items = iter(items)
+    first = list(itertools.islice(items, 1))
+
+    def generate():
+        chunk = ['{%s:[' % json.dumps(name)]
+        size = 0
+        separator = ''
+
+        for item in itertools.chain(first, items):
+            encoded = json.dumps(item)
+            chunk.append(separator + encoded)
+            separator = ','
+            size += len(encoded)
+
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk).encode('utf8')
+                chunk = []
+                size = 0
+
+        chunk.append(']')
+
+        for key, value in sorted(get_members().items()):
+            chunk.append(',%s:%s' % (json.dumps(key), json.dumps(value)))
+
+        chunk.append('}')
+        yield ''.join(chunk).encode('utf8')
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/json'
+    )
+
 def url_for(*args, **kwargs):
     ''' Override Flask's url_for to make all URLS fully qualified. '''
 
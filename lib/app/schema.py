@@ -0,0 +1,62 @@
+'''
+Bring an existing database up to date with the models without losing data.
+
+`database build` creates the schema from scratch, which drops everything. A
+database that was created (or restored from a backup) by an older version is
+upgraded instead: missing tables, columns, and indexes are added. New columns
+get their server defaults, e.g. existing images are `ready`.
+'''
+
+from sqlalchemy.engine import reflection
+from sqlalchemy.schema import CreateColumn
+
+import app.search
+from model import Base
+
+
+def upgrade(engine):
+    '''
+    Add missing tables, columns, indexes, and full text index objects, and
+    return a list of descriptions of the changes.
+    '''
+
+    changes = list()
+    inspector = reflection.Inspector.from_engine(engine)
+    preparer = engine.dialect.identifier_preparer
+    existing_tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            table.create(engine)
+            changes.append('Created table "%s".' % table.name)
+            continue
+
+        columns = inspector.get_columns(table.name)
+        column_names = {column['name'] for column in columns}
+
+        for column in table.columns:
+            if column.name not in column_names:
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                engine.execute('ALTER TABLE %s ADD COLUMN %s'
+                               % (preparer.format_table(table), ddl))
+                changes.append(
+                    'Added column "%s.%s".' % (table.name, column.name)
+                )
+
+        indexes = inspector.get_indexes(table.name)
+        index_names = {index['name'] for index in indexes}
+
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(engine)
+                changes.append('Created index "%s".' % index.name)
+
+    created = app.search.create_index(engine)
+
+    for name in created:
+        changes.append('Created full text index object "%s".' % name)
+
+    if created:
+        app.search.rebuild_index(engine)
+
+    return changes
@@ -0,0 +1,129 @@
+''' Full text search for codenames. '''
+
+import re
+
+from sqlalchemy import Column, Float, Integer, MetaData, Table, func, \
+                       literal, literal_column
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
+
+from model import Codename
+from model.codename import FULLTEXT_DDL
+
+
+# The SQLite FTS5 index is a virtual table that is maintained by triggers (see
+# model.codename). It lives in its own metadata so that create_all() does not
+# try to create it as a regular table.
+codename_fts = Table(
+    'codename_fts',
+    MetaData(),
+    Column('rowid', Integer, primary_key=True)
+)
+
+
+class MatchAgainst(ColumnElement):
+    ''' A MySQL ``MATCH (...) AGAINST (... IN BOOLEAN MODE)`` expression. '''
+
+    type = Float()
+
+    def __init__(self, columns, against):
+        ''' Constructor. '''
+
+        self.columns = columns
+        self.against = literal(against)
+
+
+@compiles(MatchAgainst, 'mysql')
+def _compile_match_against(element, compiler, **kw):
+    ''' Render a MatchAgainst expression for MySQL. '''
+
+    columns = ', '.join(compiler.process(c, **kw) for c in element.columns)
+    against = compiler.process(element.against, **kw)
+
+    return 'MATCH (%s) AGAINST (%s IN BOOLEAN MODE)' % (columns, against)
+
+
+def create_index(engine):
+    '''
+    Create any missing parts of the full text index, e.g. in a database that
+    was built before full text search existed. Returns the names of the
+    objects that were created.
+
+    Call `rebuild_index()` afterwards to index existing codenames.
+    '''
+
+    dialect = engine.dialect.name
+
+    if dialect == 'mysql':
+        rows = engine.execute('SHOW INDEX FROM codename')
+        existing = {row['Key_name'] for row in rows}
+    elif dialect == 'sqlite':
+        rows = engine.execute("SELECT name FROM sqlite_master")
+        existing = {row['name'] for row in rows}
+    else:
+        return []
+
+    created = list()
+
+    for name, statement in FULLTEXT_DDL.get(dialect, []):
+        if name not in existing:
+            engine.execute(statement)
+            created.append(name)
+
+    return created
+
+
+def get_terms(query):
+    ''' Split a user's search query into a list of words. '''
+
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+def rebuild_index(engine):
+    ''' Rebuild the full text index from the contents of the codename table. '''
+
+    dialect = engine.dialect.name
+
+    if dialect == 'mysql':
+        engine.execute('OPTIMIZE TABLE codename')
+    elif dialect == 'sqlite':
+        engine.execute(
+            "INSERT INTO codename_fts(codename_fts) VALUES ('rebuild')"
+        )
+
+
+def search_codenames(query, terms):
+    '''
+    Filter a query on the codename table so that it only matches codenames
+    whose name, summary, or description contains all of the words in
+    `terms`, ranked by relevance (best match first).
+
+    Each term is treated as a prefix so that partially typed words still
+    match. MySQL uses the FULLTEXT index and SQLite uses the FTS5 index; other
+    databases fall back to an unranked LIKE scan.
+    '''
+
+    dialect = query.session.bind.dialect.name
+
+    if dialect == 'mysql':
+        against = ' '.join('+%s*' % term for term in terms)
+        columns = (Codename.name, Codename.summary, Codename.description)
+        score = MatchAgainst(columns, against)
+        query = query.filter(score).order_by(score.desc())
+    elif dialect == 'sqlite':
+        match = ' '.join('"%s"*' % term for term in terms)
+        fts = literal_column('codename_fts')
+        query = query.join(codename_fts, codename_fts.c.rowid == Codename.id) \
+                     .filter(fts.op('MATCH')(match)) \
+                     .order_by(func.bm25(fts))
+    else:
+        for term in terms:
+            term = term.replace('%', '\%').replace('_', '\_')
+            pattern = '%{0}%'.format(term)
+            query = query.filter(
+                Codename.name.like(pattern) |
+                Codename.summary.like(pattern) |
+                Codename.description.like(pattern)
+            )
+
+    return query.order_by(Codename.name)
@@ -0,0 +1,232 @@
+''' An in-memory prefix index for codename typeahead suggestions. '''
+
+from bisect import bisect_left, bisect_right
+import re
+import threading
+
+
+def normalize(text):
+    ''' Normalize text for prefix matching: lower case words, single spaced. '''
+
+    return ' '.join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+class _SortedKeys:
+    '''
+    Codename slugs sorted by string keys, in two parallel lists. Keys that
+    start with a prefix are adjacent, so a prefix query is a binary search
+    followed by a scan. This takes a fraction of the memory of a trie.
+    '''
+
+    __slots__ = ('keys', 'slugs')
+
+    def __init__(self, pairs=()):
+        ''' Constructor. Takes (key, slug) pairs in any order. '''
+
+        pairs = sorted(pairs)
+        self.keys = [key for key, slug in pairs]
+        self.slugs = [slug for key, slug in pairs]
+
+    def add(self, key, slug):
+        ''' Add `slug` under `key`. '''
+
+        index = self._find(key, slug)
+        self.keys.insert(index, key)
+        self.slugs.insert(index, slug)
+
+    def remove(self, key, slug):
+        ''' Remove `slug` from `key`. '''
+
+        index = self._find(key, slug)
+
+        if index < len(self.keys) and self.keys[index] == key and \
+           self.slugs[index] == slug:
+            del self.keys[index]
+            del self.slugs[index]
+
+    def search(self, prefix, limit, exclude):
+        '''
+        Return up to `limit` slugs whose keys start with `prefix`, in key
+        order, skipping any slugs in `exclude`.
+        '''
+
+        results = list()
+        index = bisect_left(self.keys, prefix)
+
+        while len(results) < limit and index < len(self.keys) and \
+              self.keys[index].startswith(prefix):
+            slug = self.slugs[index]
+
+            if slug not in exclude:
+                exclude.add(slug)
+                results.append(slug)
+
+            index += 1
+
+        return results
+
+    def _find(self, key, slug):
+        ''' Return the position of (`key`, `slug`) in sorted order. '''
+
+        low = bisect_left(self.keys, key)
+        high = bisect_right(self.keys, key, low)
+
+        return bisect_left(self.slugs, slug, low, high)
+
+
+class PrefixIndex:
+    '''
+    An index of codename names that answers prefix queries in memory.
+
+    Each codename is indexed by its full name and by each word in its name,
+    so "avatar" matches "AGGRAVATED AVATAR". Matches against the start of the
+    full name are ranked ahead of matches against later words.
+
+    The index is safe to use from multiple threads. `version` records the
+    version of the codename list that the index was last rebuilt from, so that
+    callers can tell when another process has changed it. `load` is a
+    function that returns (name, slug) pairs for every codename, which
+    `refresh()` uses to rebuild the index.
+    '''
+
+    def __init__(self, load):
+        ''' Constructor. '''
+
+        self.version = None
+        self._load = load
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._names = dict()
+        self._name_keys = _SortedKeys()
+        self._word_keys = _SortedKeys()
+
+    def __len__(self):
+        ''' Return the number of indexed codenames. '''
+
+        return len(self._names)
+
+    def add(self, name, slug):
+        ''' Add (or replace) a codename. '''
+
+        with self._lock:
+            self._remove(slug)
+            self._add(name, slug)
+
+    def advance_version(self, before, after):
+        '''
+        Record that the version of the codename list changed from `before` to
+        `after` because this process changed it (and already updated the
+        index). If the index was current at `before` and no other change
+        happened in between (every version went up by exactly one), then it
+        is current at `after` and doesn't need to be rebuilt.
+        '''
+
+        with self._lock:
+            if self.version == before and \
+               all(new == old + 1 for old, new in zip(before, after)):
+                self.version = after
+
+    def rebuild(self, codenames, version=None):
+        '''
+        Replace the contents of the index with (name, slug) pairs.
+
+        The new index is built without holding the lock, so queries are
+        answered from the old index in the meantime.
+        '''
+
+        names = dict()
+        name_pairs = list()
+        word_pairs = list()
+
+        for name, slug in codenames:
+            key = normalize(name)
+            names[slug] = name
+            name_pairs.append((key, slug))
+
+            for word in key.split(' ')[1:]:
+                word_pairs.append((word, slug))
+
+        name_keys = _SortedKeys(name_pairs)
+        del name_pairs
+        word_keys = _SortedKeys(word_pairs)
+        del word_pairs
+
+        with self._lock:
+            self.version = version
+            self._names = names
+            self._name_keys = name_keys
+            self._word_keys = word_keys
+
+    def refresh(self, version):
+        '''
+        If the index isn't current at `version`, then rebuild it from `load`
+        in a background thread (unless a rebuild is already running). Until
+        it is done, queries are answered from the old index.
+        '''
+
+        with self._lock:
+            if self.version == version or self._refreshing:
+                return
+
+            self._refreshing = True
+
+        thread = threading.Thread(target=self._refresh, args=(version,))
+        thread.daemon = True
+        thread.start()
+
+    def remove(self, slug):
+        ''' Remove a codename. '''
+
+        with self._lock:
+            self._remove(slug)
+
+    def suggest(self, prefix, limit=10):
+        ''' Return up to `limit` (name, slug) pairs matching `prefix`. '''
+
+        prefix = normalize(prefix)
+
+        if prefix == '':
+            return []
+
+        with self._lock:
+            seen = set()
+            slugs = self._name_keys.search(prefix, limit, seen)
+
+            if len(slugs) < limit and ' ' not in prefix:
+                more = self._word_keys.search(prefix, limit - len(slugs), seen)
+                slugs.extend(more)
+
+            return [(self._names[slug], slug) for slug in slugs]
+
+    def _add(self, name, slug):
+        ''' Add a codename. The caller must hold the lock. '''
+
+        key = normalize(name)
+        self._names[slug] = name
+        self._name_keys.add(key, slug)
+
+        for word in key.split(' ')[1:]:
+            self._word_keys.add(word, slug)
+
+    def _refresh(self, version):
+        ''' Rebuild the index from `load`. Runs in a background thread. '''
+
+        try:
+            self.rebuild(self._load(), version)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _remove(self, slug):
+        ''' Remove a codename. The caller must hold the lock. '''
+
+        name = self._names.pop(slug, None)
+
+        if name is None:
+            return
+
+        key = normalize(name)
+        self._name_keys.remove(key, slug)
+
+        for word in key.split(' ')[1:]:
+            self._word_keys.remove(word, slug)
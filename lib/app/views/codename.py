@@ -1,22 +1,34 @@
 from datetime import datetime
-from io import BytesIO
 import os
 
-from flask import g, jsonify, request, send_from_directory
+from flask import g, jsonify, request
 from flask.ext.classy import FlaskView, route
 from PIL import Image as PILImage
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import BadRequest, Conflict, NotFound
+from sqlalchemy.orm import aliased, joinedload
+from werkzeug.exceptions import BadRequest, Conflict, NotFound, \
+                                RequestEntityTooLarge, ServiceUnavailable
 
 from app import flask_app
-import app.config
+import app.blob
+import app.cache
+import app.derivatives
+import app.ingest
 from app.authorization import admin_required, login_optional, login_required
-from app.rest import date_to_timestamp, url_for
-from model import Codename, Image, Reference, User
-from model.image import image_join_user
+from app.rest import date_to_timestamp, decode_cursor, encode_cursor, \
+                     get_limit, stream_json, url_for
+import app.search
+from model import Codename, Image, Reference
+from model.image import image_join_user, store_blob, touch_blob
 
 DEFAULT_IMAGE_URL = '/static/img/default-codename.png'
 DEFAULT_THUMB_URL = '/static/img/default-codename-thumb.png'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_SUGGEST_SIZE = 10
+MAX_SUGGEST_SIZE = 50
+STREAM_BATCH_SIZE = 500
 
 class CodenameView(FlaskView):
     ''' API for Codename and related models. '''
@@ -29,7 +41,8 @@ class CodenameView(FlaskView):
         needs_approval = list()
         unapproved_images = g.db.query(Image) \
                                 .join(Image.codename) \
-                                .filter(Image.approved==False)
+                                .filter(Image.approved==False) \
+                                .filter(Image.ready==True)
 
         for image in unapproved_images:
             approve_url = url_for(
@@ -79,6 +92,7 @@ class CodenameView(FlaskView):
 
         image.approved = True
         g.db.commit()
+        app.cache.invalidate('codenames', 'codename:' + slug)
 
         return jsonify(message='Image approved.')
 
@@ -90,6 +104,9 @@ class CodenameView(FlaskView):
 
         g.db.delete(codename)
         g.db.commit()
+        flask_app.typeahead.remove(codename.slug)
+        app.cache.invalidate('codenames', 'codename:' + slug)
+        self._invalidate_names()
 
         return jsonify(message='Codename "%s" deleted.' % codename.name)
 
@@ -104,6 +121,7 @@ class CodenameView(FlaskView):
         codename.updated = datetime.today()
         g.db.delete(reference)
         g.db.commit()
+        app.cache.invalidate('codename:' + slug)
 
         message = 'Reference %d deleted from codename "%s".'
         return jsonify(message=message % (reference.id, codename.name))
@@ -119,6 +137,7 @@ class CodenameView(FlaskView):
         codename.updated = datetime.today()
         g.db.delete(image)
         g.db.commit()
+        app.cache.invalidate('codenames', 'codename:' + slug)
 
         message = 'Image %d deleted from codename "%s".'
         return jsonify(message=message % (image.id, codename.name))
@@ -126,25 +145,43 @@ class CodenameView(FlaskView):
     @route('/<slug>/images/<int:image_id>/vote', methods=('DELETE',))
     @login_required
     def delete_image_vote(self, slug, image_id):
-        ''' Remove a vote for an image. '''
+        '''
+        Remove a vote for an image.
+
+        The vote is deleted by primary key and the tally is decremented in the
+        database only if a row was actually deleted, so this is safe to run
+        concurrently and never loads the list of voters.
+        '''
 
         codename = self._get_codename_by_slug(slug)
         image = self._get_image_for_codename(image_id, codename)
 
-        if g.user in image.voters:
-            image.voters.remove(g.user)
-            image.votes -= 1
+        delete = image_join_user.delete().where(
+            (image_join_user.c.image_id == image.id) &
+            (image_join_user.c.user_id == g.user.id)
+        )
+
+        if g.db.execute(delete).rowcount == 1:
+            self._increment_votes(image, -1)
 
+        votes = self._get_votes(image)
         g.db.commit()
+        app.cache.invalidate('codename:' + slug)
 
         return jsonify(
             voted=False,
-            votes=image.votes
+            votes=votes
         )
 
+    @app.cache.cached('codename:{slug}', 'users', per_user=True)
     @login_optional
     def get(self, slug):
-        ''' Get a codename. '''
+        '''
+        Get a codename.
+
+        The current user's vote status for all of the images is read with a
+        single query.
+        '''
 
         codename = self._get_codename_by_slug(slug)
 
@@ -159,10 +196,18 @@ class CodenameView(FlaskView):
             'references': list(),
         }
 
-        for image in codename.images:
-            voted = g.user in image.voters if g.user is not None else False
+        images = g.db.query(Image) \
+                     .options(joinedload(Image.contributor)) \
+                     .filter(Image.codename_id == codename.id) \
+                     .filter(Image.ready == True) \
+                     .order_by(Image.id) \
+                     .all()
 
-            if not image.approved and g.user is not image.contributor:
+        user_id = g.user.id if g.user is not None else None
+        voted_ids = self._get_voted_image_ids([image.id for image in images])
+
+        for image in images:
+            if not image.approved and image.contributor_id != user_id:
                 continue
 
             codename_json['images'].append({
@@ -177,7 +222,7 @@ class CodenameView(FlaskView):
                     image_id=image.id
                 ),
                 'contributor': {'username': image.contributor.username},
-                'voted': voted,
+                'voted': image.id in voted_ids,
                 'votes': image.votes,
                 'approved': image.approved,
             })
@@ -205,34 +250,56 @@ class CodenameView(FlaskView):
 
         return jsonify(**codename_json)
 
+    @route('/<slug>/images/<int:image_id>/<size>.<format_>')
+    def get_derivative(self, slug, image_id, size, format_):
+        '''
+        Send a resized and/or re-encoded copy of an image, e.g. `small.webp`.
+
+        See app.derivatives for the available sizes and formats. Copies are
+        generated on their first request and cached on disk.
+        '''
+
+        if size not in app.derivatives.SIZES:
+            raise NotFound('Image size "%s" does not exist.' % size)
+
+        if format_ not in app.derivatives.FORMATS:
+            raise NotFound('Image format "%s" is not supported.' % format_)
+
+        codename = self._get_codename_by_slug(slug)
+        image = self._get_ready_image_for_codename(image_id, codename)
+
+        rel_path = app.derivatives.get_derivative(image.path, size, format_)
+        _, mime = app.derivatives.FORMATS[format_]
+
+        return app.blob.send_blob(rel_path, mime)
+
     @route('/<slug>/images/<int:image_id>')
     def get_image(self, slug, image_id):
-        ''' Send an image. '''
+        ''' Send an image. (See app.blob.send_blob() for caching details.) '''
 
         codename = self._get_codename_by_slug(slug)
-        image = self._get_image_for_codename(image_id, codename)
-        data_dir = app.config.get_path('data')
+        image = self._get_ready_image_for_codename(image_id, codename)
 
-        return send_from_directory(data_dir, image.path)
+        return app.blob.send_blob(image.path, image.mime)
 
     @route('/<slug>/images/<int:image_id>/approval')
-    @login_optional
     def get_image_approval(self, slug, image_id):
         ''' Get an image's approval status. '''
 
         codename = self._get_codename_by_slug(slug)
         image = self._get_image_for_codename(image_id, codename)
 
-        if g.user is not None:
-            vote = g.db.query(Image) \
-                       .join(Image.voters) \
-                       .filter(User.id==g.user.id, Image.id==image_id) \
-                       .count()
-        else:
-            vote = 0
-
         return jsonify(approved=image.approved)
 
+    @route('/<slug>/images/<int:image_id>/status')
+    def get_image_status(self, slug, image_id):
+        ''' Get an uploaded image's processing status. '''
+
+        codename = self._get_codename_by_slug(slug)
+        image = self._get_image_for_codename(image_id, codename)
+
+        return jsonify(ready=image.ready)
+
     @route('/<slug>/images/<int:image_id>/vote')
     @login_optional
     def get_image_vote(self, slug, image_id):
@@ -241,19 +308,55 @@ class CodenameView(FlaskView):
         codename = self._get_codename_by_slug(slug)
         image = self._get_image_for_codename(image_id, codename)
 
-        if g.user is not None:
-            vote = g.db.query(Image) \
-                       .join(Image.voters) \
-                       .filter(User.id==g.user.id, Image.id==image_id) \
-                       .count()
-        else:
-            vote = 0
-
         return jsonify(
-            voted=(vote > 0),
+            voted=(image.id in self._get_voted_image_ids([image.id])),
             votes=image.votes
         )
 
+    @route('/votes')
+    @login_optional
+    def get_image_votes(self):
+        '''
+        Get vote status for many images at once.
+
+        The `ids` query parameter is a comma separated list of image IDs.
+        Images that do not exist, are still being processed, or that the user
+        is not allowed to see, are omitted from the response.
+        '''
+
+        try:
+            image_ids = [int(id_) for id_ in request.args['ids'].split(',')]
+        except (KeyError, ValueError):
+            message = 'The query parameter "ids" must be a comma separated' \
+                      ' list of image IDs.'
+            raise BadRequest(message)
+
+        if len(image_ids) > MAX_PAGE_SIZE:
+            message = 'No more than %d image IDs may be requested at once.'
+            raise BadRequest(message % MAX_PAGE_SIZE)
+
+        visible = Image.approved == True
+
+        if g.user is not None:
+            visible = visible | (Image.contributor_id == g.user.id)
+
+        images = g.db.query(Image.id, Image.votes) \
+                     .filter(Image.id.in_(image_ids), visible) \
+                     .filter(Image.ready == True) \
+                     .all()
+
+        voted_ids = self._get_voted_image_ids([image.id for image in images])
+        votes_json = list()
+
+        for image in images:
+            votes_json.append({
+                'id': image.id,
+                'voted': image.id in voted_ids,
+                'votes': image.votes,
+            })
+
+        return jsonify(votes=votes_json)
+
     @route('/<slug>/references/<int:reference_id>')
     def get_reference(self, slug, reference_id):
         ''' Get a reference. '''
@@ -268,62 +371,99 @@ class CodenameView(FlaskView):
 
     @route('/<slug>/images/<int:image_id>/thumbnail')
     def get_thumb(self, slug, image_id):
-        ''' Send a thumbnail. '''
+        ''' Send a thumbnail. (See app.blob.send_blob() for caching details.) '''
 
         codename = self._get_codename_by_slug(slug)
-        image = self._get_image_for_codename(image_id, codename)
-        data_dir = app.config.get_path('data')
+        image = self._get_ready_image_for_codename(image_id, codename)
 
-        return send_from_directory(data_dir, image.thumb_path)
+        return app.blob.send_blob(image.thumb_path, image.mime)
 
     @route('/')
+    @app.cache.cached('codenames')
     def index(self):
         '''
         List codenames in alphabetical order.
 
         The optional `page` query parameter is a single letter: all codenames
         beginning with that letter are returned.
-        '''
-
-        codenames = g.db.query(Codename).order_by(Codename.name)
-        count = codenames.count()
-
-        if 'page' in request.args:
-            page = request.args['page']
-
-            if len(page) > 1:
-                raise BadRequest('`page` must be a single character A-Z or a-z')
-
-            page = page[0].lower()
-            char = ord(page)
-
-            if not 97 <= char <= 122:
-                raise BadRequest('`page` must be a single character A-Z or a-z')
-
-            codenames = codenames.filter(Codename.name.like('{}%'.format(page)))
 
-        codenames_json = list()
+        Results are paginated by name. The optional `limit` query parameter
+        sets the page size (defaulting to unlimited for letter pages and to
+        `DEFAULT_PAGE_SIZE` otherwise), and `next` in the response is the URL
+        of the following page (or null on the last page). `count` is the total
+        number of codenames matching the `page` filter.
+
+        Everything is fetched in a single query: the thumbnail ID comes from a
+        correlated subquery and the total count from a scalar subquery, so the
+        number of queries does not grow with the size of the catalog. Rows are
+        read from a server-side cursor and the JSON is streamed, so memory use
+        does not grow with the size of the page either.
+        '''
 
-        for codename in codenames:
-            codename_json = {
-                'name': codename.name,
-                'slug': codename.slug,
-                'summary': codename.summary,
-                'url': url_for('CodenameView:get', slug=codename.slug)
-            }
+        page = self._get_page_letter()
 
-            if (len(codename.images) == 0):
-                codename_json['thumbUrl'] = DEFAULT_THUMB_URL
-            else:
-                codename_json['thumbUrl'] = url_for(
-                    'CodenameView:get_thumb',
-                    slug=codename.slug,
-                    image_id=codename.images[0].id
+        if page is None:
+            limit = get_limit(DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        else:
+            limit = get_limit(None, MAX_PAGE_SIZE)
+
+        counted = aliased(Codename)
+        total = g.db.query(func.count(counted.id))
+
+        codenames = g.db.query(
+            Codename.name,
+            Codename.slug,
+            Codename.summary,
+            self._thumb_id_subquery().label('thumb_id')
+        ).order_by(Codename.name)
+
+        if page is not None:
+            pattern = '{}%'.format(page)
+            total = total.filter(counted.name.like(pattern))
+            codenames = codenames.filter(Codename.name.like(pattern))
+
+        codenames = codenames.add_columns(total.as_scalar().label('total'))
+
+        if 'cursor' in request.args:
+            after = decode_cursor(request.args['cursor'])
+            codenames = codenames.filter(Codename.name > after)
+
+        if limit is not None:
+            # Fetch one extra row to find out if there is another page.
+            codenames = codenames.limit(limit + 1)
+
+        listed = {'count': None, 'last': None, 'more': False}
+
+        def results():
+            rows = codenames.yield_per(STREAM_BATCH_SIZE)
+
+            for index, row in enumerate(rows):
+                if index == 0:
+                    listed['count'] = row.total
+
+                if index == limit:
+                    listed['more'] = True
+                else:
+                    listed['last'] = row.name
+                    yield self._codename_result_json(row)
+
+            if listed['count'] is None:
+                listed['count'] = total.scalar()
+
+        def members():
+            if listed['more']:
+                next_url = url_for(
+                    'CodenameView:index',
+                    page=page,
+                    limit=limit,
+                    cursor=encode_cursor(listed['last'])
                 )
+            else:
+                next_url = None
 
-            codenames_json.append(codename_json)
+            return {'count': listed['count'], 'next': next_url}
 
-        return jsonify(codenames=codenames_json, count=count)
+        return stream_json('codenames', results(), members)
 
     @route('/', methods=('POST',))
     @admin_required
@@ -350,6 +490,10 @@ class CodenameView(FlaskView):
         except IntegrityError:
             return Conflict('Codename "%s" already exists.' % codename.name)
 
+        flask_app.typeahead.add(codename.name, codename.slug)
+        app.cache.invalidate('codenames')
+        self._invalidate_names()
+
         return jsonify(
             message='Codename "%s" created.' % codename.name,
             url=url_for('CodenameView:get', slug=codename.slug),
@@ -364,31 +508,49 @@ class CodenameView(FlaskView):
 
         This only supports image/jpeg or image/png and it expects images
         to be _exactly_ 720x400 pixels.
-        '''
 
-        REQUIRED_WIDTH = 720
-        REQUIRED_HEIGHT = 400
+        The upload is streamed to disk and hashed without being decoded. If
+        the same file has been uploaded before, its stored files are reused.
+        Otherwise only the image header is checked here, the file is stored
+        as-is, and the thumbnail is generated in the background (see
+        app.ingest): this responds with 202 and a `statusUrl` that reports
+        when the image is ready.
+        '''
 
         codename = self._get_codename_by_slug(slug)
+        content_type = request.headers.get('content-type', '').lower()
 
-        # Parse the image to make sure it is valid.
-        content_type = request.headers.get('content-type', '')
-        image = PILImage.open(BytesIO(request.data))
-        width, height = image.size
+        if content_type not in ('image/jpeg', 'image/png'):
+            raise BadRequest('The image must be a valid JPEG or PNG.')
 
-        if content_type.lower() not in ('image/jpeg', 'image/png') or \
-           image.format not in ('JPEG', 'PNG'):
-                raise BadRequest('The image must be a valid JPEG or PNG.')
+        max_length = flask_app.config['MAX_CONTENT_LENGTH']
 
-        if width != REQUIRED_WIDTH or height != REQUIRED_HEIGHT:
-            message = "Images must be exactly %d x %d pixels."
-            args = (REQUIRED_WIDTH, REQUIRED_HEIGHT)
-            raise BadRequest(message % args)
+        if (request.content_length or 0) > max_length:
+            raise RequestEntityTooLarge()
 
-        # Create database object.
-        image_obj = Image(image, g.user)
-        codename.images.append(image_obj)
-        g.db.commit()
+        upload_path, hash_ = app.ingest.spool_upload(request.stream, max_length)
+
+        try:
+            existing = g.db.query(Image) \
+                           .filter(Image.hash == hash_, Image.ready == True) \
+                           .first()
+
+            if existing is not None and touch_blob(existing.thumb_path):
+                # This exact file has been uploaded before: reuse its files
+                # instead of decoding it again. Both files are touched so
+                # that a running bin/gc.py doesn't delete them.
+                store_blob(upload_path, hash_)
+                image_obj = Image(g.user, existing.mime, hash_)
+                image_obj.thumb_path = existing.thumb_path
+                image_obj.ready = True
+                codename.images.append(image_obj)
+                g.db.commit()
+                app.cache.invalidate('codenames', 'codename:' + slug)
+            else:
+                image_obj = self._ingest_image(codename, upload_path, hash_)
+        finally:
+            if os.path.exists(upload_path):
+                os.unlink(upload_path)
 
         # Render response.
         url = url_for(
@@ -403,32 +565,58 @@ class CodenameView(FlaskView):
             image_id=image_obj.id
         )
 
-        return jsonify(
+        status_url = url_for(
+            'CodenameView:get_image_status',
+            slug=slug,
+            image_id=image_obj.id
+        )
+
+        response = jsonify(
             url=url,
             thumbUrl=thumb_url,
+            statusUrl=status_url,
             contributor={'username': image_obj.contributor.username},
             replace=(len(codename.images) == 1),
             votes=image_obj.votes,
-            approved=image_obj.approved
+            approved=image_obj.approved,
+            ready=image_obj.ready
         )
 
+        if not image_obj.ready:
+            response.status_code = 202
+
+        return response
+
     @route('/<slug>/images/<int:image_id>/vote', methods=('POST',))
     @login_required
     def post_image_vote(self, slug, image_id):
-        ''' Register a vote for an image. '''
+        '''
+        Register a vote for an image.
+
+        The vote is inserted with "insert ignore" semantics on the primary key
+        of `image_join_user` and the tally is incremented in the database only
+        if a row was actually inserted, so this is safe to run concurrently
+        and never loads the list of voters.
+        '''
 
         codename = self._get_codename_by_slug(slug)
         image = self._get_image_for_codename(image_id, codename)
 
-        if g.user not in image.voters:
-            image.voters.append(g.user)
-            image.votes += 1
+        insert = image_join_user.insert() \
+                                .prefix_with('IGNORE', dialect='mysql') \
+                                .prefix_with('OR IGNORE', dialect='sqlite') \
+                                .values(image_id=image.id, user_id=g.user.id)
 
+        if g.db.execute(insert).rowcount == 1:
+            self._increment_votes(image, 1)
+
+        votes = self._get_votes(image)
         g.db.commit()
+        app.cache.invalidate('codename:' + slug)
 
         return jsonify(
             voted=True,
-            votes=image.votes
+            votes=votes
         )
 
     @route('/<slug>/references', methods=('POST',))
@@ -449,6 +637,7 @@ class CodenameView(FlaskView):
 
         g.db.add(reference)
         g.db.commit()
+        app.cache.invalidate('codename:' + slug)
 
         return jsonify(
             message='Reference added to codename "%s".' % codename.name,
@@ -471,6 +660,7 @@ class CodenameView(FlaskView):
         codename.updated = datetime.today()
 
         g.db.commit()
+        app.cache.invalidate('codenames', 'codename:' + slug)
 
         return jsonify(message='Codename "%s" updated.' % codename.name)
 
@@ -489,53 +679,129 @@ class CodenameView(FlaskView):
         codename.updated = datetime.today()
 
         g.db.commit()
+        app.cache.invalidate('codename:' + slug)
 
         message = 'Reference updated for codename "%s".'
         return jsonify(message=message % codename.name)
 
     @route('/search')
+    @app.cache.cached('codenames')
     def search(self):
-        ''' Perform a keyword search of names and summaries. '''
+        '''
+        Perform a keyword search of names, summaries, and descriptions.
+
+        Results are ranked by relevance using the database's full text index.
+        The optional `limit` query parameter sets the page size and `next` in
+        the response is the URL of the following page (or null).
+        '''
 
         query = request.args.get('q', '').strip()
+        terms = app.search.get_terms(query)
 
-        if query == '':
-            return BadRequest('The query parameter "q" is required.')
+        if len(terms) == 0:
+            raise BadRequest('The query parameter "q" is required.')
 
-        query = query.replace('%', '\%').replace('_', '\_')
+        limit = get_limit(DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
 
-        codenames = g.db.query(Codename) \
-                        .filter(
-                            Codename.name.like('%{0}%'.format(query)) |
-                            Codename.summary.like('%{0}%'.format(query))
-                        )
+        if 'cursor' in request.args:
+            try:
+                offset = int(decode_cursor(request.args['cursor']))
+            except ValueError:
+                offset = -1
 
-        codenames_json = list()
+            if offset < 0:
+                raise BadRequest('Invalid pagination cursor.')
+        else:
+            offset = 0
+
+        codenames = g.db.query(
+            Codename.name,
+            Codename.slug,
+            Codename.summary,
+            self._thumb_id_subquery(approved_only=True).label('thumb_id')
+        )
+
+        codenames = app.search.search_codenames(codenames, terms) \
+                              .offset(offset) \
+                              .limit(limit + 1)
+
+        listed = {'more': False}
+
+        def results():
+            rows = codenames.yield_per(STREAM_BATCH_SIZE)
 
-        for codename in codenames:
-            codename_json = {
-                'name': codename.name,
-                'slug': codename.slug,
-                'summary': codename.summary,
-                'url': url_for('CodenameView:get', slug=codename.slug)
-            }
+            for index, row in enumerate(rows):
+                if index == limit:
+                    listed['more'] = True
+                else:
+                    yield self._codename_result_json(row)
 
-            for image in codename.images:
-                if image.approved:
-                    codename_json['thumbUrl'] = url_for(
-                        'CodenameView:get_thumb',
-                        slug=codename.slug,
-                        image_id=codename.images[0].id
-                    )
+        def members():
+            if listed['more']:
+                next_url = url_for(
+                    'CodenameView:search',
+                    q=query,
+                    limit=limit,
+                    cursor=encode_cursor(offset + limit)
+                )
+            else:
+                next_url = None
+
+            return {'next': next_url}
 
-                    break
+        return stream_json('codenames', results(), members)
 
-            if 'thumbUrl' not in codename_json:
-                codename_json['thumbUrl'] = DEFAULT_THUMB_URL
+    @route('/suggest')
+    def suggest(self):
+        '''
+        Suggest codenames for a partially typed name.
+
+        Matches codenames whose name, or any word in whose name, starts with
+        the query parameter `q`. This is answered from an in-memory index and
+        never queries the database: when another process adds or deletes a
+        codename, the index is rebuilt in the background.
+        '''
+
+        query = request.args.get('q', '')
+
+        if query.strip() == '':
+            raise BadRequest('The query parameter "q" is required.')
+
+        limit = get_limit(DEFAULT_SUGGEST_SIZE, MAX_SUGGEST_SIZE)
+        suggestions = list()
+
+        for name, slug in self._get_typeahead().suggest(query, limit):
+            suggestions.append({
+                'name': name,
+                'slug': slug,
+                'url': url_for('CodenameView:get', slug=slug),
+            })
+
+        return jsonify(suggestions=suggestions)
+
+    def _codename_result_json(self, row):
+        '''
+        Render a codename result (as used in lists of codenames) from a row
+        containing `name`, `slug`, `summary`, and `thumb_id` columns.
+        '''
+
+        codename_json = {
+            'name': row.name,
+            'slug': row.slug,
+            'summary': row.summary,
+            'url': url_for('CodenameView:get', slug=row.slug)
+        }
 
-            codenames_json.append(codename_json)
+        if row.thumb_id is None:
+            codename_json['thumbUrl'] = DEFAULT_THUMB_URL
+        else:
+            codename_json['thumbUrl'] = url_for(
+                'CodenameView:get_thumb',
+                slug=row.slug,
+                image_id=row.thumb_id
+            )
 
-        return jsonify(codenames=codenames_json)
+        return codename_json
 
     def _get_codename_by_slug(self, slug):
         ''' Get a codename object by its slug. '''
@@ -562,6 +828,39 @@ class CodenameView(FlaskView):
 
         return image
 
+    def _get_page_letter(self):
+        '''
+        Get the optional single letter `page` query parameter (lower case) or
+        None if it is absent.
+        '''
+
+        if 'page' not in request.args:
+            return None
+
+        page = request.args['page']
+
+        if len(page) != 1:
+            raise BadRequest('`page` must be a single character A-Z or a-z')
+
+        page = page.lower()
+        char = ord(page)
+
+        if not 97 <= char <= 122:
+            raise BadRequest('`page` must be a single character A-Z or a-z')
+
+        return page
+
+    def _get_ready_image_for_codename(self, image_id, codename):
+        ''' Get an image for a codename that has finished processing. '''
+
+        image = self._get_image_for_codename(image_id, codename)
+
+        if not image.ready:
+            message = 'Image (%d) is still being processed.'
+            raise NotFound(message % image_id)
+
+        return image
+
     def _get_reference_for_codename(self, reference_id, codename):
         ''' Get a reference for a codename. '''
 
@@ -574,3 +873,121 @@ class CodenameView(FlaskView):
             raise NotFound(message % reference_id)
 
         return reference
+
+    def _get_typeahead(self):
+        '''
+        Return the typeahead index. If codenames were added or deleted by
+        another process, then it starts rebuilding in the background.
+        '''
+
+        typeahead = flask_app.typeahead
+        typeahead.refresh(app.cache.get_versions('codename-names'))
+
+        return typeahead
+
+    def _get_voted_image_ids(self, image_ids):
+        '''
+        Return the subset of `image_ids` that the current user has voted for,
+        using a single query against the `image_join_user` table.
+        '''
+
+        if g.user is None or len(image_ids) == 0:
+            return set()
+
+        voted = g.db.query(image_join_user.c.image_id) \
+                    .filter(image_join_user.c.user_id == g.user.id) \
+                    .filter(image_join_user.c.image_id.in_(image_ids))
+
+        return {row.image_id for row in voted}
+
+    def _get_votes(self, image):
+        ''' Read an image's current vote tally from the database. '''
+
+        return g.db.query(Image.votes).filter(Image.id == image.id).scalar()
+
+    def _increment_votes(self, image, amount):
+        ''' Atomically add `amount` to an image's vote tally. '''
+
+        g.db.query(Image) \
+            .filter(Image.id == image.id) \
+            .update(
+                {Image.votes: Image.votes + amount},
+                synchronize_session=False
+            )
+
+    def _ingest_image(self, codename, upload_path, hash_):
+        '''
+        Validate a new upload by its header, store it, add it to `codename`,
+        and queue it for thumbnailing. Returns the new image.
+        '''
+
+        REQUIRED_WIDTH = 720
+        REQUIRED_HEIGHT = 400
+
+        # Pillow only reads the header until the pixel data is needed.
+        try:
+            with PILImage.open(upload_path) as image:
+                format_ = image.format
+                width, height = image.size
+        except IOError:
+            raise BadRequest('The image must be a valid JPEG or PNG.')
+
+        if format_ not in ('JPEG', 'PNG'):
+            raise BadRequest('The image must be a valid JPEG or PNG.')
+
+        if width != REQUIRED_WIDTH or height != REQUIRED_HEIGHT:
+            message = "Images must be exactly %d x %d pixels."
+            args = (REQUIRED_WIDTH, REQUIRED_HEIGHT)
+            raise BadRequest(message % args)
+
+        if not app.ingest.acquire():
+            message = 'Too many images are being processed. Try again later.'
+            raise ServiceUnavailable(message)
+
+        try:
+            store_blob(upload_path, hash_)
+            mime = 'image/jpeg' if format_ == 'JPEG' else 'image/png'
+            image_obj = Image(g.user, mime, hash_)
+            codename.images.append(image_obj)
+            g.db.commit()
+        except:
+            app.ingest.release()
+            raise
+
+        try:
+            app.ingest.submit(image_obj.id, image_obj.path)
+        except:
+            # The request fails, so don't leave an image for bin/ingest.py.
+            app.ingest.release()
+            g.db.delete(image_obj)
+            g.db.commit()
+            raise
+
+        return image_obj
+
+    def _invalidate_names(self):
+        '''
+        Tell other processes that a codename was added or deleted, after this
+        process updated its own typeahead index. This process keeps its index
+        instead of rebuilding it, unless another change happened meanwhile.
+        '''
+
+        app.cache.invalidate(
+            'codename-names',
+            bumped=flask_app.typeahead.advance_version
+        )
+
+    def _thumb_id_subquery(self, approved_only=False):
+        '''
+        Return a scalar subquery that selects the ID of the first image for
+        each codename in the enclosing query (or NULL if it has no images).
+        '''
+
+        thumb_id = g.db.query(func.min(Image.id)) \
+                       .filter(Image.codename_id == Codename.id) \
+                       .filter(Image.ready == True)
+
+        if approved_only:
+            thumb_id = thumb_id.filter(Image.approved == True)
+
+        return thumb_id.correlate(Codename).as_scalar()
@@ -5,6 +5,7 @@ from flask.ext.classy import FlaskView
 from werkzeug.exceptions import BadRequest, NotFound, Unauthorized
 
 from app import flask_app
+import app.cache
 from app.authorization import admin_required
 from app.rest import date_to_timestamp
 from model import Content, User
@@ -19,6 +20,7 @@ class ContentView(FlaskView):
     into a template.
     '''
 
+    @app.cache.cached('content:{name}')
     def get(self, name):
         ''' Get a piece of Markdown content. '''
 
@@ -40,6 +42,7 @@ class ContentView(FlaskView):
         content.updated = datetime.today()
 
         g.db.commit()
+        app.cache.invalidate('content:' + name)
 
         return jsonify(message='Content "%s" updated.' % name)
 
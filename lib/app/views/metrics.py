@@ -0,0 +1,18 @@
+""" Application metrics for monitoring systems. """
+
+from app import flask_app
+
+@flask_app.route('/api/metrics')
+def metrics():
+    """
+    Render the metrics of all processes of this application in the Prometheus
+    text format.
+
+    This is meant to be scraped by Prometheus, so it does not require
+    authentication. Restrict access to it in the web server if needed.
+    """
+
+    return flask_app.response_class(
+        flask_app.metrics.render(),
+        mimetype='text/plain; version=0.0.4'
+    )
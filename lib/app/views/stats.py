@@ -0,0 +1,31 @@
+''' Operational statistics for administrators. '''
+
+from flask import jsonify
+from flask.ext.classy import FlaskView, route
+
+import app.cache
+import app.database
+from app.authorization import admin_required
+
+class StatsView(FlaskView):
+    ''' Statistics that are useful for tuning the application. '''
+
+    @route('/cache')
+    @admin_required
+    def cache(self):
+        ''' Get response cache statistics for this process. '''
+
+        return jsonify(cache=app.cache.get_stats())
+
+    @route('/pool')
+    @admin_required
+    def pool(self):
+        '''
+        Get database connection pool statistics for this process.
+
+        Counters are cumulative since the process started. `waitSeconds` is the
+        total time spent waiting for a free connection, and `timeouts` counts
+        checkouts that gave up after `[database] pool_timeout` seconds.
+        '''
+
+        return jsonify(pool=app.database.get_pool_stats())
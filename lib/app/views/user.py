@@ -6,7 +6,8 @@ from flask import abort, g, jsonify, request
 from flask.ext.classy import FlaskView, route
 from werkzeug.exceptions import BadRequest, Unauthorized
 
-from app.authorization import login_required
+import app.cache
+from app.authorization import invalidate_user, login_required
 from model import User
 
 class UserView(FlaskView):
@@ -38,7 +39,8 @@ class UserView(FlaskView):
 
         CHANGE_TIME = 15
 
-        user_account_age = datetime.today() - g.user.added
+        user = g.db.query(User).filter(User.id==g.user.id).one()
+        user_account_age = datetime.today() - user.added
 
         if user_account_age.seconds > CHANGE_TIME * 60:
             message =  'You are only allowed to change your username within' \
@@ -46,7 +48,9 @@ class UserView(FlaskView):
             raise Unauthorized(message)
 
         request_json = request.get_json()
-        g.user.username = request_json['username']
+        user.username = request_json['username']
         g.db.commit()
+        invalidate_user(user.id)
+        app.cache.invalidate('users')
 
         return jsonify(message='Username changed successfully.')
@@ -41,6 +41,25 @@ class BackupCli(cli.BaseCli):
             raise cli.CliError('Failed to dump MySQL database!')
 
 
+    def _exclude(self, tarinfo):
+        '''
+        Filter for tarfile: skip directories that only hold derived or
+        temporary files.
+        '''
+
+        excluded = (
+            'data/cache',
+            'data/derivatives',
+            'data/incoming',
+            'data/metrics',
+            'data/publish',
+        )
+
+        if tarinfo.name in excluded:
+            return None
+
+        return tarinfo
+
     def _run(self, args, config):
         ''' Main entry point. '''
 
@@ -73,7 +92,7 @@ class BackupCli(cli.BaseCli):
                  tarfile.open(fileobj=tar_temp, mode='w:gz') as tarball:
 
                 self._logger.info('Backing up {}'.format(data_dir))
-                tarball.add(data_dir, arcname='data')
+                tarball.add(data_dir, arcname='data', filter=self._exclude)
                 tarball.close()
                 tar_temp.flush()
                 tar_temp.seek(0)
@@ -5,8 +5,11 @@ from sqlalchemy.schema import DropConstraint, DropTable, ForeignKeyConstraint, \
                               MetaData, Table
 
 import app.database
+import app.schema
+import app.search
 import cli
-from model import Base, Codename, Content, Image, Reference
+from model import Base, Content
+import model.sample
 
 
 class DatabaseCli(cli.BaseCli):
@@ -39,62 +42,15 @@ class DatabaseCli(cli.BaseCli):
 
         session.commit()
 
-    def _create_sample_data(self):
+    def _create_sample_data(self, count, workers):
         ''' Create sample data. '''
 
-        session = app.database.get_session(self._db)
-
-        aggravated_avatar = Codename("AGGRAVATED AVATAR")
-        aggravated_avatar.summary = dedent('''
-            Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed porta
-            sagittis mi a faucibus.
-        ''')
-        aggravated_avatar.description = dedent('''
-            Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed porta
-            sagittis mi a faucibus. Etiam lacinia id ex eu accumsan. Duis at
-            venenatis tortor, nec ultricies enim.
-        ''')
-        aggravated_avatar.references.append(Reference(
-            'http://yahoo.com', 'Lorem ipsum dolor sit amet.'
-        ))
-        aggravated_avatar.references.append(Reference(
-            'http://google.com', 'Lorem ipsum dolor sit amet.'
-        ))
-        session.add(aggravated_avatar)
-
-        amused_bouche = Codename("AMUSED BOUCHE")
-        amused_bouche.summary = dedent('''
-            Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed porta
-            sagittis mi a faucibus.
-        ''')
-        amused_bouche.description = dedent('''
-            Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed porta
-            sagittis mi a faucibus.
-        ''')
-        amused_bouche.references.append(Reference(
-            'http://apple.com', 'Lorem ipsum dolor sit amet.'
-        ))
-        session.add(amused_bouche)
-
-        bored_boxer = Codename("BORED BOXER")
-        bored_boxer.summary = dedent('''
-            Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed porta
-            sagittis mi a faucibus.
-        ''')
-        bored_boxer.description = dedent('''
-            Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed porta
-            sagittis mi a faucibus. Etiam lacinia id ex eu accumsan. Duis at
-            venenatis tortor, nec ultricies enim.
-        ''')
-        bored_boxer.references.append(Reference(
-            'http://ibm.com', 'Lorem ipsum dolor sit amet.'
-        ))
-        bored_boxer.references.append(Reference(
-            'http://microsoft.com', 'Lorem ipsum dolor sit amet.'
-        ))
-        session.add(bored_boxer)
-
-        session.commit()
+        model.sample.generate(
+            self._db,
+            count,
+            workers=workers,
+            log=self._logger.info
+        )
 
     def _drop_all(self):
         '''
@@ -107,6 +63,10 @@ class DatabaseCli(cli.BaseCli):
         See: https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/DropEverything
         '''
 
+        if self._db.dialect.name == 'sqlite':
+            self._drop_all_sqlite()
+            return
+
         tables = list()
         all_fks = list()
         metadata = MetaData()
@@ -139,13 +99,48 @@ class DatabaseCli(cli.BaseCli):
 
         self._session.commit()
 
+    def _drop_all_sqlite(self):
+        '''
+        Drop all tables from a SQLite database.
+
+        SQLite can't drop foreign keys, so foreign key enforcement is turned
+        off instead. Virtual (full text) tables are dropped first, which also
+        drops their shadow tables such as codename_fts_data. Triggers are
+        dropped along with their tables.
+        '''
+
+        with self._db.connect() as connection:
+            connection.execute('PRAGMA foreign_keys = OFF')
+
+            tables = connection.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'table'"
+            ).fetchall()
+
+            for name, sql in tables:
+                if (sql or '').upper().startswith('CREATE VIRTUAL TABLE'):
+                    connection.execute('DROP TABLE "%s"' % name)
+
+            tables = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+                " AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+
+            for name, in tables:
+                connection.execute('DROP TABLE "%s"' % name)
+
+            connection.execute('PRAGMA foreign_keys = ON')
+
     def _get_args(self, arg_parser):
         ''' Customize arguments. '''
 
         arg_parser.add_argument(
             'action',
-            choices=('build','drop'),
-            help='Specify what action to take.'
+            choices=('build','drop','reindex','upgrade'),
+            help='Specify what action to take. "reindex" creates the full'
+                 ' text index if it is missing and rebuilds it, and'
+                 ' "upgrade" adds missing tables, columns, and indexes to a'
+                 ' database created by an older version. Neither touches'
+                 ' any data.'
         )
 
         arg_parser.add_argument(
@@ -156,8 +151,19 @@ class DatabaseCli(cli.BaseCli):
 
         arg_parser.add_argument(
             '--sample-data',
-            action='store_true',
-            help='Create sample data.'
+            type=int,
+            nargs='?',
+            const=100,
+            metavar='N',
+            help='Create N codenames of sample data, with references, users,'
+                 ' images, and votes. (Default: 100)'
+        )
+
+        arg_parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of processes used to generate sample images.'
+                 ' (Default: one per CPU)'
         )
 
     def _run(self, args, config):
@@ -188,4 +194,18 @@ class DatabaseCli(cli.BaseCli):
 
         if args.sample_data:
             self._logger.info('Creating sample data.')
-            self._create_sample_data()
+            self._create_sample_data(args.sample_data, args.workers)
+
+        if args.action == 'upgrade':
+            self._logger.info('Upgrading database schema.')
+
+            for change in app.schema.upgrade(self._db):
+                self._logger.info(change)
+
+        if args.action == 'reindex':
+            for name in app.search.create_index(self._db):
+                self._logger.info('Created missing full text index object'
+                                  ' "%s".' % name)
+
+            self._logger.info('Rebuilding full text index.')
+            app.search.rebuild_index(self._db)
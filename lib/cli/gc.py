@@ -0,0 +1,275 @@
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import string
+import time
+
+from app.config import get_path
+import app.database
+import cli
+from model import Image
+
+
+class GcCli(cli.BaseCli):
+    '''
+    Delete files in the data directory that are not referenced by any image.
+    '''
+
+    def _collect_references(self, session):
+        '''
+        Return the hashes of all files referenced by the database, as a list
+        of 256 sorted arrays: one per shard (see `_scan_shard()`).
+
+        Only the first 64 bits of each hash are kept, in arrays of 8 byte
+        integers, so that millions of references fit in a few dozen MB. A
+        collision can only cause an unreferenced file to be kept, never a
+        referenced file to be deleted.
+        '''
+
+        references = [array('Q') for _ in range(256)]
+        paths = session.query(Image.path, Image.thumb_path).yield_per(10000)
+
+        for row in paths:
+            for path in row:
+                key = self._get_key(path)
+
+                if key is not None:
+                    references[key >> 56].append(key)
+
+        # Sort one shard at a time to limit the size of the temporary list.
+        for index, keys in enumerate(references):
+            references[index] = array('Q', sorted(keys))
+
+        return references
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--debug-db',
+            action='store_true',
+            help='Print database queries.'
+        )
+
+        arg_parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report unreferenced files without deleting them.'
+        )
+
+        arg_parser.add_argument(
+            '--grace-hours',
+            type=float,
+            default=24,
+            help='Only delete files older than this many hours, so that'
+                 ' files belonging to in-progress uploads are kept.'
+                 ' (Defaults to 24.)'
+        )
+
+        arg_parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Number of directories to scan in parallel. (Defaults to 8.)'
+        )
+
+    def _get_key(self, path):
+        '''
+        Convert a data directory path like "a/b/cdef..." to a compact hash key,
+        or return None if the path is not a content addressed file.
+        '''
+
+        if path is None:
+            return None
+
+        hash_ = path.replace(os.sep, '')
+
+        if len(hash_) < 16 or \
+           any(char not in string.hexdigits for char in hash_):
+            return None
+
+        return int(hash_[:16], 16)
+
+    def _remove(self, path, dry_run):
+        ''' Remove a file, or just report it in a dry run. '''
+
+        if dry_run:
+            self._logger.info('Unreferenced: %s' % path)
+            return
+
+        self._logger.debug('Deleting: %s' % path)
+
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self._logger.warning('Not able to delete "%s": %s' % (path, e))
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        if args.debug_db:
+            # Configure database logging.
+            log_level = getattr(logging, args.verbosity.upper())
+
+            db_logger = logging.getLogger('sqlalchemy.engine')
+            db_logger.setLevel(log_level)
+            db_logger.addHandler(self._log_handler)
+
+        database_config = dict(config.items('database'))
+        engine = app.database.get_engine(database_config)
+        session = app.database.get_session(engine)
+
+        self._logger.info('Reading file references from the database.')
+
+        try:
+            references = self._collect_references(session)
+        finally:
+            session.close()
+
+        count = sum(len(keys) for keys in references)
+        self._logger.info('Found %d references to files.' % count)
+
+        data_dir = get_path('data')
+        cutoff = time.time() - args.grace_hours * 3600
+        shards = list()
+
+        for char1 in string.hexdigits[:16]:
+            for char2 in string.hexdigits[:16]:
+                shards.append(char1 + char2)
+
+        totals = {'files': 0, 'unreferenced': 0, 'bytes': 0}
+
+        def scan(shard):
+            return self._scan_shard(
+                data_dir,
+                shard,
+                references[int(shard, 16)],
+                cutoff,
+                args.dry_run
+            )
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for counts in executor.map(scan, shards):
+                for key, value in counts.items():
+                    totals[key] += value
+
+        # Spooled uploads that were never moved into place are abandoned.
+        incoming = self._scan_incoming(
+            os.path.join(data_dir, 'incoming'),
+            cutoff,
+            args.dry_run
+        )
+
+        temporary = self._scan_temporary(
+            os.path.join(data_dir, 'derivatives'),
+            cutoff,
+            args.dry_run
+        )
+
+        verb = 'Would delete' if args.dry_run else 'Deleted'
+        message = 'Scanned %d files. %s %d unreferenced files (%d bytes),' \
+                  ' %d abandoned uploads, and %d abandoned derivatives.'
+        self._logger.info(message % (
+            totals['files'],
+            verb,
+            totals['unreferenced'],
+            totals['bytes'],
+            incoming,
+            temporary
+        ))
+
+    def _scan_incoming(self, incoming_dir, cutoff, dry_run):
+        ''' Remove abandoned uploads. Returns the number of files removed. '''
+
+        count = 0
+
+        try:
+            entries = os.scandir(incoming_dir)
+        except FileNotFoundError:
+            return count
+
+        with entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    self._remove(entry.path, dry_run)
+                    count += 1
+
+        return count
+
+    def _scan_shard(self, data_dir, shard, references, cutoff, dry_run):
+        '''
+        Remove unreferenced files older than `cutoff` from one shard directory
+        (e.g. shard "ab" is the directory "data/a/b"). `references` is the
+        shard's sorted array of referenced hash keys. Returns a dictionary of
+        counts.
+        '''
+
+        counts = {'files': 0, 'unreferenced': 0, 'bytes': 0}
+        shard_dir = os.path.join(data_dir, shard[0], shard[1])
+
+        try:
+            entries = os.scandir(shard_dir)
+        except FileNotFoundError:
+            return counts
+
+        with entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+
+                counts['files'] += 1
+
+                # Temporary files are left behind by writers that crashed
+                # before renaming them into place.
+                if not entry.name.endswith('.tmp'):
+                    key = self._get_key(shard + entry.name)
+
+                    if key is None or _contains(references, key):
+                        continue
+
+                stat = entry.stat()
+
+                if stat.st_mtime >= cutoff:
+                    continue
+
+                self._remove(entry.path, dry_run)
+                counts['unreferenced'] += 1
+                counts['bytes'] += stat.st_size
+
+        return counts
+
+    def _scan_temporary(self, root, cutoff, dry_run):
+        '''
+        Remove temporary files older than `cutoff` anywhere under `root`.
+        Returns the number of files removed.
+        '''
+
+        count = 0
+
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                if not file_name.endswith('.tmp'):
+                    continue
+
+                path = os.path.join(dir_path, file_name)
+
+                try:
+                    if os.stat(path).st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+
+                self._remove(path, dry_run)
+                count += 1
+
+        return count
+
+
+def _contains(sorted_keys, key):
+    ''' Return True if the sorted array `sorted_keys` contains `key`. '''
+
+    index = bisect_left(sorted_keys, key)
+
+    return index < len(sorted_keys) and sorted_keys[index] == key
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+
+import app.cache
+import app.database
+import cli
+from model import Image
+from model.image import store_thumbnail
+
+
+class IngestCli(cli.BaseCli):
+    '''
+    Finish processing uploaded images that a web process did not finish, e.g.
+    because it exited or its worker process died.
+
+    Only images that were queued more than --lease-minutes ago are processed,
+    so that images which a web process is still working on are left alone.
+    Each image is claimed by resetting its `queued` time, so concurrent runs
+    don't process the same image.
+    '''
+
+    def _claim(self, session, image_id, cutoff):
+        ''' Claim an image. Returns False if another process claimed it. '''
+
+        claimed = session.query(Image) \
+                         .filter(Image.id == image_id) \
+                         .filter(Image.ready == False) \
+                         .filter(or_(Image.queued == None,
+                                     Image.queued < cutoff)) \
+                         .update({Image.queued: datetime.now()},
+                                 synchronize_session=False)
+        session.commit()
+
+        return claimed == 1
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--lease-minutes',
+            type=float,
+            default=30,
+            help='Only process images that were queued more than this many'
+                 ' minutes ago. (Defaults to 30.)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        database_config = dict(config.items('database'))
+        engine = app.database.get_engine(database_config)
+        session = app.database.get_session(engine)
+        cutoff = datetime.now() - timedelta(minutes=args.lease_minutes)
+        app.cache.init(config)
+
+        try:
+            stranded = session.query(Image.id) \
+                              .filter(Image.ready == False) \
+                              .filter(or_(Image.queued == None,
+                                          Image.queued < cutoff)) \
+                              .order_by(Image.id) \
+                              .all()
+
+            self._logger.info('Found %d unfinished images.' % len(stranded))
+
+            for image_id, in stranded:
+                if self._claim(session, image_id, cutoff):
+                    self._process(session, image_id)
+        finally:
+            session.close()
+
+    def _process(self, session, image_id):
+        '''
+        Generate the thumbnail of a claimed image and mark it ready, or delete
+        the image if it can't be processed.
+        '''
+
+        image = session.query(Image).filter(Image.id == image_id).one()
+        slug = image.codename.slug
+
+        try:
+            image.thumb_path = store_thumbnail(image.path)
+            image.ready = True
+            self._logger.info('Processed image %d.' % image_id)
+        except Exception:
+            self._logger.exception('Unable to process image %d. Deleting it.'
+                                   % image_id)
+            session.delete(image)
+
+        session.commit()
+        app.cache.invalidate('codenames', 'codename:' + slug)
@@ -0,0 +1,362 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import string
+import tempfile
+from urllib.parse import parse_qs, urlsplit
+
+import app
+from app.config import get_path
+import app.database
+import cli
+from model import Codename, Content, Image
+
+# Use the process pool when at least this many codenames must be rendered.
+POOL_THRESHOLD = 200
+
+STATE_FILE = '.publish-state.json'
+
+_base_url = None
+_client = None
+_publish_dir = None
+
+
+class PublishCli(cli.BaseCli):
+    '''
+    Render the public API to static JSON files that the web server can serve
+    to anonymous users without running the application.
+
+    Files are written to the publish directory:
+
+        codename/index.json            GET /api/codename/
+        codename/index/<cursor>.json   GET /api/codename/?limit=100&cursor=...
+        codename/letter/<A-Z>.json     GET /api/codename/?page=<A-Z>
+        codename/detail/<slug>.json    GET /api/codename/<slug>
+        content/<name>.json            GET /api/content/<name>
+
+    URLs in the files are absolute, so they are rendered for `[publish]
+    base_url`. The index is published page by page, following its `next`
+    links, exactly as the API paginates it.
+
+    The first run renders everything. Later runs only render codenames whose
+    `updated` time or approved images changed (and the list pages, if any
+    codename changed) and content that was updated. A file that could not be
+    rendered is retried by the next run.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Render everything, even if it has not changed.'
+        )
+
+        arg_parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of processes for rendering many codenames. (Defaults'
+                 ' to one per CPU.)'
+        )
+
+    def _get_codename_fingerprints(self, session):
+        '''
+        Return a dict of codename slugs to a string that changes whenever the
+        codename's public detail changes.
+        '''
+
+        approved = dict()
+
+        images = session.query(Image.codename_id, Image.id) \
+                        .filter(Image.approved == True, Image.ready == True) \
+                        .order_by(Image.id) \
+                        .yield_per(10000)
+
+        for codename_id, image_id in images:
+            approved.setdefault(codename_id, []).append(str(image_id))
+
+        fingerprints = dict()
+
+        codenames = session.query(Codename.id, Codename.slug,
+                                  Codename.updated) \
+                           .yield_per(10000)
+
+        for codename_id, slug, updated in codenames:
+            fingerprints[slug] = '%s|%s' % (
+                updated.isoformat() if updated is not None else '',
+                ','.join(approved.get(codename_id, []))
+            )
+
+        return fingerprints
+
+    def _get_content_fingerprints(self, session):
+        ''' Return a dict of content names to their update times. '''
+
+        return {
+            name: updated.isoformat() if updated is not None else ''
+            for name, updated in session.query(Content.name, Content.updated)
+        }
+
+    def _load_state(self, state_path):
+        '''
+        Load the fingerprints saved by the last run, or empty fingerprints if
+        there was no previous run or it used a different base URL.
+        '''
+
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            state = None
+
+        if state is None or state.get('baseUrl') != _base_url:
+            state = {'codenames': {}, 'content': {}, 'lists': False}
+
+        return state
+
+    def _render_codenames(self, slugs, workers):
+        '''
+        Render codename detail files, in a process pool if many. Returns a set
+        of the slugs whose files were written.
+        '''
+
+        if len(slugs) < POOL_THRESHOLD:
+            return _render_details(slugs)
+
+        # Workers are forked so that they inherit the bootstrapped app, but
+        # they must not share this process's database connections.
+        database_config = dict(self._config.items('database'))
+        engines = [app.database.get_engine(database_config)] + \
+                  app.database.get_replica_engines(database_config)
+
+        for engine in engines:
+            engine.dispose()
+
+        chunks = [slugs[i:i + 100] for i in range(0, len(slugs), 100)]
+        context = multiprocessing.get_context('fork')
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=context) as executor:
+            written = set()
+
+            for chunk_written in executor.map(_render_details, chunks):
+                written.update(chunk_written)
+                self._logger.debug('Rendered %d of %d codenames.'
+                                   % (len(written), len(slugs)))
+
+        return written
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        global _base_url, _client, _publish_dir
+
+        self._config = config
+        _publish_dir = get_path(config.get('publish', 'dir'))
+        state_path = os.path.join(_publish_dir, STATE_FILE)
+        _base_url = config.get('publish', 'base_url').strip()
+
+        if _base_url == '':
+            raise cli.CliError('Set base_url in the [publish] section of'
+                               ' local.ini to the public URL of the site.')
+
+        _base_url = _base_url.rstrip('/') + '/'
+        _client = app.bootstrap(record_metrics=False).test_client()
+
+        if args.full:
+            state = {'codenames': {}, 'content': {}, 'lists': False}
+        else:
+            state = self._load_state(state_path)
+
+        database_config = dict(config.items('database'))
+        engine = app.database.get_engine(database_config)
+        session = app.database.get_session(engine)
+
+        try:
+            codenames = self._get_codename_fingerprints(session)
+            contents = self._get_content_fingerprints(session)
+        finally:
+            session.close()
+
+        changed = sorted(
+            slug for slug, fingerprint in codenames.items()
+            if state['codenames'].get(slug) != fingerprint
+        )
+        removed = sorted(set(state['codenames']) - set(codenames))
+        changed_content = sorted(
+            name for name, fingerprint in contents.items()
+            if state['content'].get(name) != fingerprint
+        )
+
+        self._logger.info(
+            'Rendering %d of %d codenames and %d content pages. Removing %d'
+            ' codenames.' % (len(changed), len(codenames),
+                             len(changed_content), len(removed))
+        )
+
+        # Details are rendered first: when that uses worker processes, they
+        # must be forked before this process opens any connections.
+        written = self._render_codenames(changed, args.workers)
+
+        for slug in removed:
+            try:
+                os.unlink(_get_path('codename/detail/%s.json' % slug))
+            except FileNotFoundError:
+                pass
+
+        lists = state.get('lists', False)
+
+        if changed or removed or not lists:
+            lists = _render_index()
+
+            for letter in string.ascii_uppercase:
+                url = '/api/codename/?page=' + letter
+                path = 'codename/letter/%s.json' % letter
+                lists = _write(path, _render(url)) and lists
+
+        for name in changed_content:
+            path = 'content/%s.json' % name
+
+            if not _write(path, _render('/api/content/' + name)):
+                contents[name] = state['content'].get(name)
+
+        # Files that failed to render keep their old fingerprints (if any), so
+        # that the next run tries again.
+        for slug in set(changed) - written:
+            codenames[slug] = state['codenames'].get(slug)
+
+        failed = len(changed) - len(written)
+
+        if failed > 0:
+            self._logger.warning('Unable to render %d codenames.' % failed)
+
+        # Save the state last, so that an interrupted run is repeated.
+        state = {
+            'baseUrl': _base_url,
+            'codenames': codenames,
+            'content': contents,
+            'lists': lists,
+        }
+        _write(STATE_FILE, json.dumps(state).encode('utf8'))
+
+        self._logger.info('Published to %s.' % _publish_dir)
+
+
+def _get_path(rel_path):
+    ''' Return the absolute path of a file in the publish directory. '''
+
+    return os.path.join(_publish_dir, *rel_path.split('/'))
+
+
+def _render(url, strip_user_fields=False):
+    '''
+    Render an anonymous GET request and return the response body, or None if
+    the request failed.
+
+    If `strip_user_fields` is True, then fields that describe the current
+    user (such as whether they voted for an image) are removed.
+    '''
+
+    response = _client.get(
+        url,
+        base_url=_base_url,
+        headers={'accept': 'application/json'}
+    )
+
+    if response.status_code != 200:
+        return None
+
+    if not strip_user_fields:
+        return response.get_data()
+
+    body = json.loads(response.get_data(as_text=True))
+
+    for image in body.get('images', []):
+        image.pop('voted', None)
+
+    return json.dumps(body, separators=(',', ':')).encode('utf8')
+
+
+def _render_details(slugs):
+    '''
+    Render the detail file of each codename and return a set of the slugs
+    whose files were written. May run in a worker.
+    '''
+
+    written = set()
+
+    for slug in slugs:
+        detail = _render('/api/codename/' + slug, strip_user_fields=True)
+
+        if _write('codename/detail/%s.json' % slug, detail):
+            written.add(slug)
+
+    return written
+
+
+def _render_index():
+    '''
+    Render every page of the codename index, following `next` links, and
+    remove pages that a previous run published but the index no longer has.
+    Returns False if any page failed to render.
+    '''
+
+    url = '/api/codename/'
+    rel_path = 'codename/index.json'
+    pages = set()
+
+    while url is not None:
+        body = _render(url)
+
+        if body is None:
+            return False
+
+        _write(rel_path, body)
+        url = json.loads(body.decode('utf8'))['next']
+
+        if url is not None:
+            # Links are absolute, but the test client needs a path.
+            url = '/' + url[len(_base_url):]
+            cursor = parse_qs(urlsplit(url).query)['cursor'][0]
+            rel_path = 'codename/index/%s.json' % cursor
+            pages.add('%s.json' % cursor)
+
+    try:
+        old_pages = set(os.listdir(_get_path('codename/index')))
+    except FileNotFoundError:
+        old_pages = set()
+
+    for name in old_pages - pages:
+        os.unlink(_get_path('codename/index/' + name))
+
+    return True
+
+
+def _write(rel_path, data):
+    '''
+    Atomically replace a file in the publish directory, so that the web
+    server never reads a partial file. Does nothing if `data` is None.
+    Returns True if the file was written.
+    '''
+
+    if data is None:
+        return False
+
+    path = _get_path(rel_path)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            temp.write(data)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+    return True
@@ -15,6 +15,7 @@ from boto.s3.key import Key
 
 from app.config import get_path
 import app.database
+import app.schema
 import cli
 
 
@@ -166,6 +167,8 @@ class RestoreCli(cli.BaseCli):
 
                     with open(mysql_path, 'r') as mysql_backup:
                         self._load_mysql(mysql_backup)
+
+                    self._upgrade_schema()
         finally:
             try:
                 os.unlink(mysql_path)
@@ -204,3 +207,15 @@ class RestoreCli(cli.BaseCli):
             self._restore(bucket, args.s3file)
 
         self._logger.info('Finished.')
+
+    def _upgrade_schema(self):
+        '''
+        Upgrade the restored database, which may have been backed up by an
+        older version.
+        '''
+
+        self._logger.info('Upgrading database schema.')
+        engine = app.database.get_engine(self._db_config, super_user=True)
+
+        for change in app.schema.upgrade(engine):
+            self._logger.info(change)
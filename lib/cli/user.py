@@ -1,4 +1,6 @@
+import app.cache
 import app.database
+from app.authorization import invalidate_user
 import cli
 from model import User
 
@@ -46,4 +48,8 @@ class UserCli(cli.BaseCli):
 
         session.commit()
 
+        # Make running web workers reload the user's privileges.
+        app.cache.init(config)
+        invalidate_user(user.id)
+
         self._logger.info('User "%s" is admin: %s' % (args.user, user.is_admin))
@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from slugify import slugify
-from sqlalchemy import Column, DateTime, Integer, String, Text
+from sqlalchemy import Column, DateTime, DDL, Integer, String, Text, event
 from sqlalchemy.orm import relationship
 
 from model import Base
@@ -42,3 +42,55 @@ class Codename(Base):
         self.description = 'Summary placeholder text.'
         self.added = datetime.today()
         self.updated = datetime.today()
+
+
+# Full text indexes are created with raw DDL because each database has its own
+# syntax. SQLite uses an external content FTS5 table that is kept in sync with
+# the codename table by triggers. Each statement is listed with the name of the
+# object it creates, so that app.search.create_index() can add missing objects
+# to an existing database.
+FULLTEXT_DDL = {
+    'mysql': [
+        ('ft_codename',
+         'ALTER TABLE codename ADD FULLTEXT INDEX ft_codename'
+         ' (name, summary, description)'),
+    ],
+    'sqlite': [
+        ('codename_fts',
+         "CREATE VIRTUAL TABLE codename_fts USING fts5"
+         " (name, summary, description, content='codename',"
+         " content_rowid='id')"),
+
+        ('codename_fts_insert',
+         'CREATE TRIGGER codename_fts_insert AFTER INSERT ON codename BEGIN'
+         ' INSERT INTO codename_fts (rowid, name, summary, description)'
+         ' VALUES (new.id, new.name, new.summary, new.description);'
+         ' END'),
+
+        ('codename_fts_delete',
+         'CREATE TRIGGER codename_fts_delete AFTER DELETE ON codename BEGIN'
+         ' INSERT INTO codename_fts'
+         ' (codename_fts, rowid, name, summary, description)'
+         " VALUES ('delete', old.id, old.name, old.summary,"
+         " old.description);"
+         ' END'),
+
+        ('codename_fts_update',
+         'CREATE TRIGGER codename_fts_update AFTER UPDATE ON codename BEGIN'
+         ' INSERT INTO codename_fts'
+         ' (codename_fts, rowid, name, summary, description)'
+         " VALUES ('delete', old.id, old.name, old.summary,"
+         " old.description);"
+         ' INSERT INTO codename_fts (rowid, name, summary, description)'
+         ' VALUES (new.id, new.name, new.summary, new.description);'
+         ' END'),
+    ],
+}
+
+for dialect, statements in FULLTEXT_DDL.items():
+    for _, statement in statements:
+        event.listen(
+            Codename.__table__,
+            'after_create',
+            DDL(statement).execute_if(dialect=dialect)
+        )
@@ -1,8 +1,14 @@
+from datetime import datetime
 import hashlib
+from io import BytesIO
 import os
+import tempfile
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Table
+from PIL import Image as PILImage
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, \
+                       String, Table
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import true
 
 import app.config
 from model import Base
@@ -65,41 +71,105 @@ class Image(Base):
     )
 
     mime = Column(String(255))
+    hash = Column(String(40), index=True)
+    ready = Column(Boolean, server_default=true())
+    queued = Column(DateTime)
 
-    def __init__(self, image, contributor):
+    def __init__(self, contributor, mime, hash_):
         '''
         Constructor.
 
-        This takes a Pillow `image` and a user `contributor`. It saves the
-        image to the data directory and generates a thumbnail (also saved to
-        the data directory).
+        This takes a user `contributor` (anything with an `id`, such as a User
+        or an AuthenticatedUser), the image's MIME type, and the SHA-1 hash of
+        the uploaded file, which must already be stored in the data directory
+        (see `store_blob()`). The image is not ready until its
+        thumbnail has been generated by `store_thumbnail()` and `thumb_path`
+        has been filled in. `queued` is when it was last queued for that (see
+        app.ingest).
         '''
 
-        # Save the file (if not already present).
-        data_dir = app.config.get_path('data')
-        hash_ = hashlib.sha1(image.tobytes()).hexdigest()
-        image_dir = os.path.join(data_dir, hash_[0], hash_[1])
-        image_path = os.path.join(image_dir, hash_[2:])
-        image_rel_path = os.path.join(hash_[0], hash_[1], hash_[2:])
-
-        if not os.path.exists(image_path):
-            os.makedirs(image_dir, exist_ok=True)
-            image.save(image_path, format=image.format)
-
-        # Create and save a thumbnail (if not already present).
-        thumb = image.thumbnail((THUMB_WIDTH, THUMB_HEIGHT))
-        thumb_hash = hashlib.sha1(image.tobytes()).hexdigest()
-        thumb_dir = os.path.join(data_dir, thumb_hash[0], thumb_hash[1])
-        thumb_path = os.path.join(thumb_dir, thumb_hash[2:])
-        thumb_rel_path = os.path.join(thumb_hash[0], thumb_hash[1], thumb_hash[2:])
-
-        if not os.path.exists(thumb_path):
-            os.makedirs(thumb_dir, exist_ok=True)
-            image.save(thumb_path, format=image.format)
-
-        self.path = image_rel_path
-        self.thumb_path = thumb_rel_path
-        self.mime = 'image/jpeg' if image.format == 'JPEG' else 'image/png'
-        self.contributor = contributor
+        self.path = get_blob_path(hash_)
+        self.hash = hash_
+        self.mime = mime
+        self.contributor_id = contributor.id
         self.votes = 0
         self.approved = False
+        self.ready = False
+        self.queued = datetime.now()
+
+
+def get_blob_path(hash_):
+    '''
+    Return the path (relative to the data directory) of a file with the given
+    SHA-1 hash.
+    '''
+
+    return os.path.join(hash_[0], hash_[1], hash_[2:])
+
+
+def store_blob(temp_path, hash_):
+    '''
+    Move the file at `temp_path`, whose contents have the SHA-1 hash `hash_`,
+    into the data directory and return its relative path.
+
+    If a file with the same hash is already stored, then `temp_path` is
+    removed instead and the stored file is touched (see `touch_blob()`).
+    '''
+
+    rel_path = get_blob_path(hash_)
+    path = os.path.join(app.config.get_path('data'), rel_path)
+
+    if touch_blob(rel_path):
+        os.unlink(temp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    return rel_path
+
+
+def store_thumbnail(rel_path):
+    '''
+    Generate a thumbnail for the image stored at `rel_path`, save it to the
+    data directory (if not already present), and return its relative path.
+    '''
+
+    data_dir = app.config.get_path('data')
+    image = PILImage.open(os.path.join(data_dir, rel_path))
+    format_ = image.format
+    image.thumbnail((THUMB_WIDTH, THUMB_HEIGHT))
+
+    thumb = BytesIO()
+    image.save(thumb, format=format_)
+    thumb = thumb.getvalue()
+
+    thumb_rel_path = get_blob_path(hashlib.sha1(thumb).hexdigest())
+    thumb_path = os.path.join(data_dir, thumb_rel_path)
+
+    if not touch_blob(thumb_rel_path):
+        thumb_dir = os.path.dirname(thumb_path)
+        os.makedirs(thumb_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=thumb_dir, suffix='.tmp')
+
+        with os.fdopen(fd, 'wb') as thumb_file:
+            thumb_file.write(thumb)
+
+        os.replace(temp_path, thumb_path)
+
+    return thumb_rel_path
+
+
+def touch_blob(rel_path):
+    '''
+    Update the modification time of a stored file that is about to be
+    referenced again, so that `bin/gc.py` (which only deletes files older
+    than its grace period) doesn't delete it based on an older snapshot of
+    references. Returns False if the file doesn't exist.
+    '''
+
+    try:
+        os.utime(os.path.join(app.config.get_path('data'), rel_path))
+    except FileNotFoundError:
+        return False
+
+    return True
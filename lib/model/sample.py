@@ -0,0 +1,315 @@
+'''
+Generate large, realistic sample datasets for development and benchmarking.
+
+Rows are inserted with batched Core `executemany` statements and primary keys
+are assigned here instead of by the database, so that related rows can be
+inserted without reading keys back. Images are generated and thumbnailed in a
+process pool and stored in the normal content-addressed layout. Output is
+deterministic for a given `seed`.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+import hashlib
+import os
+import random
+import tempfile
+
+from PIL import Image as PILImage
+from slugify import slugify
+from sqlalchemy import func, select
+
+import app.config
+from model.codename import Codename
+from model.image import Image, image_join_user, store_blob, store_thumbnail
+from model.reference import Reference
+from model.user import User
+
+BATCH_SIZE = 1000
+
+IMAGE_WIDTH = 720
+IMAGE_HEIGHT = 400
+
+# Images are expensive to generate and store, so a dataset shares a limited
+# number of distinct files among its image rows, just like duplicate uploads.
+MAX_DISTINCT_IMAGES = 2000
+
+SYLLABLES = (
+    'AB', 'AL', 'AN', 'AR', 'BA', 'BO', 'BRA', 'CA', 'CHI', 'CO', 'DA', 'DE',
+    'DRA', 'EL', 'EN', 'ER', 'FA', 'FI', 'GA', 'GLO', 'HA', 'HE', 'IN', 'IS',
+    'JA', 'KA', 'KE', 'LA', 'LI', 'LO', 'MA', 'ME', 'MO', 'NA', 'NE', 'NO',
+    'OR', 'PA', 'PE', 'QUA', 'RA', 'RE', 'RO', 'SA', 'SE', 'SHA', 'SO', 'STA',
+    'TA', 'TE', 'TO', 'TRA', 'UL', 'UN', 'VA', 'VE', 'WA', 'WI', 'XE', 'YA',
+    'ZA', 'ZE',
+)
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed porta'
+    ' sagittis mi faucibus etiam lacinia id ex eu accumsan duis at venenatis'
+    ' tortor nec ultricies enim fusce aliquam sem vulputate integer'
+    ' vestibulum lacus dui euismod bibendum program network collection'
+    ' implant exploit router cable satellite intercept database analyst'
+    ' target signal operation partner access'
+).split()
+
+# Dates are spread over this period.
+EPOCH = datetime(2013, 6, 1)
+PERIOD = timedelta(days=3 * 365)
+
+
+def generate(engine, codenames, seed=0, workers=None, log=None):
+    '''
+    Add `codenames` synthetic codenames to the database, along with
+    references, users, images (about one for every two codenames), and
+    votes.
+
+    `workers` is the size of the image process pool (default: one per CPU).
+    `log`, if given, is called with progress messages.
+    '''
+
+    log = log or (lambda message: None)
+    rng = random.Random(seed)
+    user_count = max(codenames // 10, 10)
+    image_count = codenames // 2
+
+    with engine.connect() as connection:
+        ids = _IdAllocator(connection)
+
+        log('Inserting %d users.' % user_count)
+        user_ids = _insert_users(connection, ids, rng, user_count)
+
+        log('Inserting %d codenames and their references.' % codenames)
+        codename_ids = _insert_codenames(connection, ids, rng, codenames)
+
+        distinct = min(image_count, MAX_DISTINCT_IMAGES)
+        log('Generating %d distinct images.' % distinct)
+        files = _generate_images(rng, distinct, workers)
+
+        log('Inserting %d images and their votes.' % image_count)
+        _insert_images(
+            connection, ids, rng, image_count, files, codename_ids, user_ids
+        )
+
+
+def make_image(seed):
+    '''
+    Return the bytes of a 720x400 JPEG that is unique to `seed`: a gradient
+    with a few random shapes on it.
+    '''
+
+    rng = random.Random(seed)
+    start = [rng.randrange(256) for _ in range(3)]
+    end = [rng.randrange(256) for _ in range(3)]
+
+    gradient = PILImage.linear_gradient('L').resize(
+        (IMAGE_WIDTH, IMAGE_HEIGHT)
+    )
+    image = PILImage.new('RGB', (IMAGE_WIDTH, IMAGE_HEIGHT), tuple(start))
+    image.paste(tuple(end), mask=gradient)
+
+    for _ in range(rng.randrange(3, 8)):
+        x, y = rng.randrange(IMAGE_WIDTH), rng.randrange(IMAGE_HEIGHT)
+        width, height = rng.randrange(20, 200), rng.randrange(20, 200)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        image.paste(color, (x, y, x + width, y + height))
+
+    jpeg = BytesIO()
+    image.save(jpeg, format='JPEG', quality=85)
+
+    return jpeg.getvalue()
+
+
+def store_image(seed):
+    '''
+    Generate an image with `make_image()`, store it and its thumbnail in the
+    data directory, and return (hash, thumbnail path).
+
+    This runs in a worker process.
+    '''
+
+    data = make_image(seed)
+    hash_ = hashlib.sha1(data).hexdigest()
+    incoming_dir = app.config.get_path('data/incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=incoming_dir)
+
+    with os.fdopen(fd, 'wb') as temp:
+        temp.write(data)
+
+    rel_path = store_blob(temp_path, hash_)
+
+    return hash_, store_thumbnail(rel_path)
+
+
+class _IdAllocator:
+    ''' Assign primary keys following the largest existing key of a table. '''
+
+    def __init__(self, connection):
+        ''' Constructor. '''
+
+        self._connection = connection
+        self._next = dict()
+
+    def take(self, model, count):
+        ''' Return a range of `count` new primary keys for `model`. '''
+
+        if model not in self._next:
+            query = select([func.max(model.id)])
+            max_id = self._connection.execute(query).scalar()
+            self._next[model] = (max_id or 0) + 1
+
+        start = self._next[model]
+        self._next[model] += count
+
+        return range(start, start + count)
+
+
+def _date(rng):
+    ''' Return a random date in PERIOD after EPOCH. '''
+
+    seconds = rng.randrange(int(PERIOD.total_seconds()))
+
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def _execute_batched(connection, table, rows):
+    ''' Insert `rows` into `table` in batches, each in one transaction. '''
+
+    for start in range(0, len(rows), BATCH_SIZE):
+        with connection.begin():
+            connection.execute(
+                table.insert(),
+                rows[start:start + BATCH_SIZE]
+            )
+
+
+def _generate_images(rng, count, workers):
+    ''' Store `count` distinct images and return (hash, thumb path) pairs. '''
+
+    seeds = [rng.getrandbits(64) for _ in range(count)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(store_image, seeds, chunksize=16))
+
+
+def _insert_codenames(connection, ids, rng, count):
+    ''' Insert codenames with references and return their IDs. '''
+
+    codename_rows = list()
+    reference_rows = list()
+    names = set()
+
+    for codename_id in ids.take(Codename, count):
+        name = _name(rng)
+
+        while name in names:
+            name = _name(rng)
+
+        names.add(name)
+        added = _date(rng)
+
+        codename_rows.append({
+            'id': codename_id,
+            'name': name,
+            'slug': slugify(name),
+            'summary': _paragraph(rng, 1, 2),
+            'description': '\n\n'.join(
+                _paragraph(rng, 2, 6) for _ in range(rng.randrange(1, 5))
+            ),
+            'added': added,
+            'updated': added + timedelta(days=rng.randrange(365)),
+        })
+
+        for _ in range(rng.randrange(5)):
+            reference_rows.append({
+                'codename_id': codename_id,
+                'url': 'https://example.com/%s/%d' % (
+                    rng.choice(WORDS), rng.randrange(10 ** 6)
+                ),
+                'annotation': _sentence(rng)[:255],
+            })
+
+    for reference_id, row in zip(ids.take(Reference, len(reference_rows)),
+                                 reference_rows):
+        row['id'] = reference_id
+
+    _execute_batched(connection, Codename.__table__, codename_rows)
+    _execute_batched(connection, Reference.__table__, reference_rows)
+
+    return [row['id'] for row in codename_rows]
+
+
+def _insert_images(connection, ids, rng, count, files, codename_ids,
+                   user_ids):
+    ''' Insert images that use the stored `files`, and votes for them. '''
+
+    image_rows = list()
+    vote_rows = list()
+
+    for image_id in ids.take(Image, count):
+        hash_, thumb_path = rng.choice(files)
+        voters = rng.sample(user_ids, min(rng.randrange(30), len(user_ids)))
+
+        image_rows.append({
+            'id': image_id,
+            'codename_id': rng.choice(codename_ids),
+            'contributor_id': rng.choice(user_ids),
+            'path': os.path.join(hash_[0], hash_[1], hash_[2:]),
+            'thumb_path': thumb_path,
+            'mime': 'image/jpeg',
+            'hash': hash_,
+            'votes': len(voters),
+            'approved': rng.random() < 0.9,
+            'ready': True,
+        })
+
+        for user_id in voters:
+            vote_rows.append({'image_id': image_id, 'user_id': user_id})
+
+    _execute_batched(connection, Image.__table__, image_rows)
+    _execute_batched(connection, image_join_user, vote_rows)
+
+
+def _insert_users(connection, ids, rng, count):
+    ''' Insert users and return their IDs. '''
+
+    rows = list()
+
+    for index, user_id in enumerate(ids.take(User, count)):
+        rows.append({
+            'id': user_id,
+            'username': 'sample-user-%d' % user_id,
+            'image_url': '/static/img/default-user.png',
+            'is_admin': index == 0,
+            'added': _date(rng),
+        })
+
+    _execute_batched(connection, User.__table__, rows)
+
+    return [row['id'] for row in rows]
+
+
+def _name(rng):
+    ''' Return a random codename, e.g. "TRABO ZEMAL". '''
+
+    return ' '.join(
+        ''.join(rng.choice(SYLLABLES) for _ in range(rng.randrange(2, 4)))
+        for _ in range(rng.randrange(1, 3) + 1)
+    )
+
+
+def _paragraph(rng, min_sentences, max_sentences):
+    ''' Return a paragraph of random sentences. '''
+
+    count = rng.randrange(min_sentences, max_sentences + 1)
+
+    return ' '.join(_sentence(rng) for _ in range(count))
+
+
+def _sentence(rng):
+    ''' Return a random sentence. '''
+
+    words = [rng.choice(WORDS) for _ in range(rng.randrange(6, 20))]
+
+    return ' '.join(words).capitalize() + '.'
@@ -196,21 +196,11 @@ class CodenameComponent {
             Map<String,String> response = JSON.decode(event.target.response);
 
             if (event.target.status == 200) {
-                Image image = new Image(response);
-
-                if (response['replace'] && this.codename.images.length > 0) {
-                    this.codename.images[0] = image;
-                } else {
-                    this.codename.images.add(image);
-                    this.currentImageIndex = this.codename.images.length - 1;
-                }
+                this._addImage(response);
+            } else if (event.target.status == 202) {
+                this._waitForImage(response);
             } else {
-                this.status = response['message'];
-                Element warning = querySelector('div.alert');
-
-                if (warning != null) {
-                    warning.scrollIntoView();
-                }
+                this._showError(response['message']);
             }
 
             new Timer(new Duration(seconds: 1), () {
@@ -233,4 +223,52 @@ class CodenameComponent {
         this.currentImageIndex = (this.currentImageIndex + delta) %
                                  this.codename.images.length;
     }
+
+    void _addImage(Map response) {
+        Image image = new Image(response);
+
+        if (response['replace'] && this.codename.images.length > 0) {
+            this.codename.images[0] = image;
+        } else {
+            this.codename.images.add(image);
+            this.currentImageIndex = this.codename.images.length - 1;
+        }
+    }
+
+    void _showError(String message) {
+        this.status = message;
+        Element warning = querySelector('div.alert');
+
+        if (warning != null) {
+            warning.scrollIntoView();
+        }
+    }
+
+    void _waitForImage(Map response, [int attempts = 0]) {
+        // The server is still processing the upload: poll until it's ready,
+        // for up to two minutes.
+        if (attempts >= 120) {
+            this._showError('Your image is taking a long time to process.'
+                            ' Reload the page later to see it.');
+            return;
+        }
+
+        new Timer(new Duration(seconds: 1), () {
+            HttpRequest.request(
+                response['statusUrl'],
+                requestHeaders: {'Accept': 'application/json'}
+            ).then((request) {
+                Map status = JSON.decode(request.response);
+
+                if (status['ready']) {
+                    this._addImage(response);
+                } else {
+                    this._waitForImage(response, attempts + 1);
+                }
+            }).catchError((e) {
+                // The server deletes images that it can't process.
+                this._showError('Your image could not be processed.');
+            });
+        });
+    }
 }
@@ -0,0 +1,137 @@
+'''
+Fixtures for tests that run the application against a temporary SQLite
+database.
+
+    python3 -m pytest tests
+
+The application is bootstrapped once per test run, with the configuration
+from conf/ overridden so that nothing is written outside a temporary
+directory. Response caching is disabled and every table is emptied after each
+test.
+'''
+
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+from itsdangerous import Signer
+from sqlalchemy import event
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import app
+import app.config
+import app.database
+from model import Base
+
+
+@pytest.fixture(scope='session')
+def config(tmpdir_factory):
+    ''' The application configuration, pointed at a temporary directory. '''
+
+    temp_dir = str(tmpdir_factory.mktemp('nsa-codenames'))
+    config = app.config.get_config()
+    config.set('cache', 'max_bytes', '0')
+    config.set('cache', 'shared_dir', os.path.join(temp_dir, 'cache'))
+    config.set('database', 'driver', 'sqlite')
+    config.set('database', 'url', '')
+    config.set('database', 'replicas', '')
+    config.set('database', 'sqlite_path', os.path.join(temp_dir, 'db.sqlite'))
+    config.set('flask', 'SECRET_KEY', 'test')
+    config.set('profiler', 'enabled', 'no')
+
+    return config
+
+
+@pytest.fixture(scope='session')
+def engine(config):
+    ''' The database engine, with the schema created. '''
+
+    engine = app.database.get_engine(dict(config.items('database')))
+    Base.metadata.create_all(engine)
+
+    return engine
+
+
+@pytest.fixture(scope='session')
+def flask_app(config, engine):
+    ''' The bootstrapped application. '''
+
+    get_config = app.config.get_config
+    app.config.get_config = lambda: config
+
+    try:
+        return app.bootstrap(record_metrics=False)
+    finally:
+        app.config.get_config = get_config
+
+
+@pytest.fixture
+def auth(config):
+    '''
+    Return a function that returns the headers which authenticate a request
+    as a user.
+    '''
+
+    signer = Signer(config.get('flask', 'SECRET_KEY'))
+
+    def auth(user):
+        token = signer.sign(str(user.id).encode('utf8')).decode('utf8')
+        return {'auth': token}
+
+    return auth
+
+
+@pytest.fixture
+def client(flask_app):
+    ''' A test client. '''
+
+    return flask_app.test_client()
+
+
+@pytest.fixture
+def session(engine):
+    ''' A database session. Every table is emptied after the test. '''
+
+    session = app.database.get_session(engine)
+
+    yield session
+
+    session.close()
+
+    for table in reversed(Base.metadata.sorted_tables):
+        engine.execute(table.delete())
+
+
+@pytest.fixture
+def count_queries(engine):
+    '''
+    Return a context manager that counts the SQL statements executed inside
+    it, e.g.:
+
+        with count_queries() as queries:
+            client.get('/api/codename/')
+
+        assert queries.count == 1
+    '''
+
+    class Counter:
+        count = 0
+
+    @contextmanager
+    def count_queries():
+        counter = Counter()
+
+        def count(*args):
+            counter.count += 1
+
+        event.listen(engine, 'before_cursor_execute', count)
+
+        try:
+            yield counter
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+    return count_queries
+
@@ -0,0 +1,243 @@
+import socketserver
+import threading
+
+import pytest
+
+from app.cache_backends import MemcachedBackend, MemoryBackend, \
+                               SharedMemoryBackend
+
+
+class FakeMemcached(socketserver.ThreadingTCPServer):
+    '''
+    A stand-in for a memcached server that speaks the subset of the text
+    protocol used by MemcachedBackend. `data` maps keys to stored bytes, so
+    tests can inspect it or delete keys to simulate eviction.
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        ''' Constructor. Listens on a free port on the loopback interface. '''
+
+        super().__init__(('127.0.0.1', 0), _FakeMemcachedHandler)
+        self.data = dict()
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        ''' The "host:port" of the server. '''
+
+        return '%s:%d' % self.server_address
+
+
+class _FakeMemcachedHandler(socketserver.StreamRequestHandler):
+    ''' Handle one client connection to a FakeMemcached server. '''
+
+    def handle(self):
+        ''' Answer commands until the client disconnects. '''
+
+        for line in self.rfile:
+            command, *args = line.decode('ascii').split()
+
+            with self.server.lock:
+                response = getattr(self, '_' + command)(*args)
+
+            self.wfile.write(response)
+
+    def _add(self, key, flags, ttl, length):
+        ''' Store a value unless the key exists. '''
+
+        value = self._read_value(length)
+
+        if key in self.server.data:
+            return b'NOT_STORED\r\n'
+
+        self.server.data[key] = value
+        return b'STORED\r\n'
+
+    def _get(self, *keys):
+        ''' Return the values of the keys that exist. '''
+
+        response = b''
+
+        for key in keys:
+            if key in self.server.data:
+                value = self.server.data[key]
+                response += b'VALUE %s 0 %d\r\n%s\r\n' % \
+                            (key.encode('ascii'), len(value), value)
+
+        return response + b'END\r\n'
+
+    def _incr(self, key, amount):
+        ''' Increment a numeric value. '''
+
+        if key not in self.server.data:
+            return b'NOT_FOUND\r\n'
+
+        value = str(int(self.server.data[key]) + int(amount)).encode('ascii')
+        self.server.data[key] = value
+        return value + b'\r\n'
+
+    def _read_value(self, length):
+        ''' Read the data block of a storage command. '''
+
+        return self.rfile.read(int(length) + 2)[:-2]
+
+    def _set(self, key, flags, ttl, length):
+        ''' Store a value. '''
+
+        self.server.data[key] = self._read_value(length)
+        return b'STORED\r\n'
+
+
+@pytest.fixture
+def memcached():
+    ''' A running FakeMemcached server. '''
+
+    server = FakeMemcached()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['memory', 'shared', 'memcached'])
+def backends(request, tmpdir):
+    '''
+    Return a function that creates a backend of each type. Backends created
+    by one test share their cache (where the type supports that) and always
+    share their versions, like the processes on one host do.
+    '''
+
+    versions_path = str(tmpdir.join('versions'))
+    store_path = str(tmpdir.join('store'))
+
+    if request.param == 'memory':
+        return lambda: MemoryBackend(1024, versions_path)
+    elif request.param == 'shared':
+        return lambda: SharedMemoryBackend(store_path, 4096, versions_path,
+                                           buckets=64)
+    else:
+        server = request.getfixturevalue('memcached')
+        return lambda: MemcachedBackend([server.address], 60)
+
+
+def test_get_returns_what_was_set(backends):
+    ''' Values can be read back, and hits and misses are counted. '''
+
+    backend = backends()
+
+    assert backend.get('key') is None
+
+    backend.set('key', b'value')
+    backend.set('other', b'other value')
+
+    assert backend.get('key') == b'value'
+    assert backend.get('other') == b'other value'
+    assert backend.stats()['hits'] == 2
+    assert backend.stats()['misses'] == 1
+
+
+def test_set_replaces_value(backends):
+    ''' Setting an existing key replaces its value. '''
+
+    backend = backends()
+    backend.set('key', b'old')
+    backend.set('key', b'new')
+
+    assert backend.get('key') == b'new'
+
+
+def test_versions_are_shared(backends):
+    ''' A bump in one process is seen by the others. '''
+
+    first = backends()
+    second = backends()
+
+    before = first.get_versions(['codenames', 'codename:x'])
+    assert second.get_versions(['codenames', 'codename:x']) == before
+
+    second.bump_versions(['codename:x'])
+    after = first.get_versions(['codenames', 'codename:x'])
+
+    assert after[0] == before[0]
+    assert after[1] == before[1] + 1
+
+
+def test_memory_backend_evicts_least_recently_used(tmpdir):
+    ''' The memory backend stays within its budget by evicting LRU entries. '''
+
+    backend = MemoryBackend(10, str(tmpdir.join('versions')))
+    backend.set('a', b'aaaa')
+    backend.set('b', b'bbbb')
+    backend.get('a')
+    backend.set('c', b'cccc')
+
+    assert backend.get('a') == b'aaaa'
+    assert backend.get('b') is None
+    assert backend.get('c') == b'cccc'
+    assert backend.stats()['evictions'] == 1
+    assert backend.stats()['bytes'] == 8
+
+    backend.set('big', b'x' * 11)
+    assert backend.get('big') is None
+
+
+def test_shared_backend_is_shared_and_evicts_oldest(tmpdir):
+    ''' The shared backend is shared by processes and evicts the oldest. '''
+
+    store_path = str(tmpdir.join('store'))
+    versions_path = str(tmpdir.join('versions'))
+    first = SharedMemoryBackend(store_path, 1000, versions_path, buckets=64)
+    second = SharedMemoryBackend(store_path, 1000, versions_path, buckets=64)
+
+    first.set('key', b'value')
+    assert second.get('key') == b'value'
+
+    # Writing more than the ring holds overwrites the oldest entries.
+    for number in range(10):
+        second.set('key%d' % number, b'%d' % number * 200)
+
+    assert first.get('key') is None
+    assert first.get('key9') == b'9' * 200
+
+    # Entries larger than a quarter of the ring are not stored.
+    first.set('big', b'x' * 251)
+    assert second.get('big') is None
+
+
+def test_memcached_evicted_version_is_not_reused(memcached):
+    ''' A version counter evicted by memcached restarts at a new value. '''
+
+    backend = MemcachedBackend([memcached.address], 60)
+    before = backend.get_versions(['codenames'])
+
+    with memcached.lock:
+        memcached.data.clear()
+
+    # A new counter starts at the current time in milliseconds and is bumped
+    # past it, so it can't match the versions that entries were cached under.
+    backend.bump_versions(['codenames'])
+    assert backend.get_versions(['codenames']) != before
+
+
+def test_memcached_outage_keeps_last_versions(memcached):
+    ''' Versions stay stable while memcached is unreachable. '''
+
+    backend = MemcachedBackend([memcached.address], 60, timeout=0.1)
+    backend.set('key', b'value')
+    known = backend.get_versions(['codenames'])
+
+    memcached.shutdown()
+    memcached.server_close()
+    backend._disconnect(backend._key('key'))
+
+    assert backend.get('key') is None
+    assert backend.get_versions(['codenames']) == known
+    assert backend.get_versions(['codenames']) == known
+    assert backend.get_versions(['unknown']) == (-1,)
@@ -0,0 +1,50 @@
+from model import Codename, Image, User
+
+
+def _add_codenames(session, contributor, start, stop):
+    ''' Add codenames that each have two approved images. '''
+
+    images = list()
+
+    for number in range(start, stop):
+        codename = Codename('Codename %04d' % number)
+        session.add(codename)
+        session.flush()
+
+        for copy in range(2):
+            path = 'images/%04d-%d.png' % (number, copy)
+            images.append({
+                'codename_id': codename.id,
+                'contributor_id': contributor.id,
+                'path': path,
+                'thumb_path': path,
+                'mime': 'image/png',
+                'votes': 0,
+                'approved': True,
+            })
+
+    session.execute(Image.__table__.insert(), images)
+    session.commit()
+
+
+def test_index_query_count_is_constant(client, session, count_queries):
+    ''' The number of queries must not grow with the number of codenames. '''
+
+    contributor = User('contributor')
+    session.add(contributor)
+    session.commit()
+
+    counts = list()
+
+    for start, stop in ((0, 5), (5, 50), (50, 200)):
+        _add_codenames(session, contributor, start, stop)
+
+        for url in ('/api/codename/', '/api/codename/?page=C&limit=1000'):
+            with count_queries() as queries:
+                response = client.get(url)
+                response.get_data()
+
+            assert response.status_code == 200
+            counts.append(queries.count)
+
+    assert len(set(counts)) == 1
@@ -0,0 +1,79 @@
+import threading
+
+from sqlalchemy import func
+
+from model import Codename, Image, User
+from model.image import image_join_user
+
+VOTERS = 16
+
+
+def test_concurrent_votes_match_voters(flask_app, session, auth):
+    '''
+    Concurrent votes on the same image must not lose updates: the tally must
+    equal the number of rows in `image_join_user`.
+    '''
+
+    users = [User('voter%02d' % number) for number in range(VOTERS)]
+    session.add_all(users)
+    session.commit()
+
+    codename = Codename('Example')
+    session.add(codename)
+    session.flush()
+    image_id = session.execute(Image.__table__.insert(), {
+        'codename_id': codename.id,
+        'contributor_id': users[0].id,
+        'path': 'images/example.png',
+        'thumb_path': 'images/example.png',
+        'mime': 'image/png',
+        'votes': 0,
+        'approved': True,
+    }).inserted_primary_key[0]
+    session.commit()
+
+    url = '/api/codename/example/images/%d/vote' % image_id
+    barrier = threading.Barrier(VOTERS)
+    errors = list()
+
+    def vote(user_id, headers):
+        client = flask_app.test_client()
+        barrier.wait()
+
+        try:
+            # Every user votes twice; odd users then take their vote back.
+            responses = [
+                client.post(url, headers=headers),
+                client.post(url, headers=headers),
+            ]
+
+            if user_id % 2 == 1:
+                responses.append(client.delete(url, headers=headers))
+
+            for response in responses:
+                assert response.status_code == 200
+        except Exception as exception:
+            errors.append(exception)
+
+    threads = [
+        threading.Thread(target=vote, args=(user.id, auth(user)))
+        for user in users
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    session.expire_all()
+    votes = session.query(Image.votes).filter(Image.id == image_id).scalar()
+    voters = session.query(func.count()) \
+                    .select_from(image_join_user) \
+                    .filter(image_join_user.c.image_id == image_id) \
+                    .scalar()
+
+    assert voters == len([user for user in users if user.id % 2 == 0])
+    assert votes == voters
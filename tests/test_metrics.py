@@ -0,0 +1,25 @@
+import os
+
+from app.metrics import Registry
+
+
+def test_exited_processes_are_merged(tmpdir):
+    ''' Samples of exited processes are kept, but their files are not. '''
+
+    directory = str(tmpdir.join('metrics'))
+    registry = Registry(directory)
+    requests = registry.counter('requests', 'Requests.')
+    requests.inc(path='/')
+
+    for number in range(3):
+        pid = os.fork()
+
+        if pid == 0:
+            requests.inc(2, path='/')
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        assert 'requests{path="/"} %d' % (3 + 2 * number) in registry.render()
+
+    assert sorted(os.listdir(directory)) == \
+        ['%d.db' % os.getpid(), 'exited.db', 'lock']
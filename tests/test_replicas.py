@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import json
+
+import pytest
+import sqlalchemy
+
+import app
+import app.authorization
+import app.cache
+import app.config
+import app.database
+from model import Base, Codename, User
+
+
+@pytest.fixture
+def replica_app(config, tmpdir, monkeypatch):
+    '''
+    An application bootstrapped with a primary SQLite database and a
+    read-only replica in another file. Each database has one codename, named
+    after it, and an admin user.
+    '''
+
+    replica_config = app.config.merge_config_files()
+    replica_config.read_dict({
+        section: dict(config.items(section)) for section in config.sections()
+    })
+
+    for name in ('primary', 'replica'):
+        path = str(tmpdir.join(name + '.sqlite'))
+        engine = sqlalchemy.create_engine('sqlite:///' + path)
+        Base.metadata.create_all(engine)
+        session = app.database.get_session(engine)
+        admin = User('admin')
+        admin.is_admin = True
+        session.add_all([admin, Codename(name.title())])
+        session.commit()
+        session.close()
+        engine.dispose()
+
+    primary_path = str(tmpdir.join('primary.sqlite'))
+    replica_url = 'sqlite:///' + str(tmpdir.join('replica.sqlite'))
+    replica_config.set('database', 'sqlite_path', primary_path)
+    replica_config.set('database', 'replicas', replica_url)
+
+    # Bootstrap a second application with its own engines and caches. The
+    # originals are restored after the test.
+    monkeypatch.setattr(app, 'flask_app', None)
+    monkeypatch.setattr(app.authorization, '_users', OrderedDict())
+    monkeypatch.setattr(app.cache, '_backend', None)
+    monkeypatch.setattr(app.cache, '_replica_lag', 0)
+    monkeypatch.setattr(app.config, 'get_config', lambda: replica_config)
+    monkeypatch.setattr(app.database, '_engine', None)
+    monkeypatch.setattr(app.database, '_replica_engines', None)
+    flask_app = app.bootstrap(record_metrics=False)
+
+    yield flask_app
+
+    for engine in [app.database._engine] + app.database._replica_engines:
+        engine.dispose()
+
+
+def _get_names(client):
+    ''' Return the names of the codenames in the index. '''
+
+    response = client.get('/api/codename/')
+    body = json.loads(response.get_data(as_text=True))
+
+    return [codename['name'] for codename in body['codenames']]
+
+
+def test_reads_go_to_replica(replica_app):
+    ''' GET requests read from the replica. '''
+
+    assert _get_names(replica_app.test_client()) == ['Replica']
+
+
+def test_write_sticks_client_to_primary(replica_app, auth):
+    ''' After a write, the client's reads go to the primary for a while. '''
+
+    client = replica_app.test_client()
+    admin = User('admin')
+    admin.id = 1
+
+    response = client.post(
+        '/api/codename/',
+        data=json.dumps({'name': 'New'}),
+        content_type='application/json',
+        headers=auth(admin)
+    )
+
+    assert response.status_code == 200
+    assert 'read_primary_until=' in response.headers['Set-Cookie']
+    assert _get_names(client) == ['New', 'Primary']
+
+    # Other clients still read from the replica.
+    assert _get_names(replica_app.test_client()) == ['Replica']